@@ -0,0 +1,128 @@
+"""
+Benchmarks the /geolocation-service-category-analytics aggregation against
+the row by row implementation it replaced, and checks both agree.
+
+    python -m benchmarks.category_weights --rows 100000
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+from main import GeometryEnum, category_paths, format_value, geolocation_category_weights
+
+
+def legacy_row_to_category_weights(count_of_service_categories_df, x):
+    index, row = x
+    pathname = row['pathname']
+    previous_params_route = row['previousParamsRoute']
+    path_components = pathname.split('/')
+    first_component = path_components[1]
+    if first_component in category_paths:
+        return {'index' : index, first_component :  1 }
+    elif previous_params_route in category_paths:
+        return {'index' : index, previous_params_route: 1}
+    elif first_component == 'locations' and len(path_components) == 3:
+        slug = path_components[2]
+        row = count_of_service_categories_df[count_of_service_categories_df.index == slug][['category', 'percentage']].set_index('category')['percentage'].to_dict()
+        return {
+            'index': index,
+            **row
+        }
+
+    return {'index' : index, 'unknown': 1}
+
+
+def legacy_geolocation_category_weights(category_df, count_of_service_categories_df, geometry_type):
+    # The implementation this benchmark replaced, minus the stray overwrite of
+    # the last category with the row's raw event count.
+    category_weights_df = pd.DataFrame([
+        legacy_row_to_category_weights(count_of_service_categories_df, x) for x in category_df.iterrows()
+    ]).set_index('index')
+    lookup_map = {}
+    for index, row in category_df.iterrows():
+        district = row[geometry_type.value]
+        if pd.isna(district):
+            continue
+        district = format_value(district, geometry_type)
+        num_geolocation_events = int(row['numGeolocationEvents'])
+        category_weights = category_weights_df.loc[index].to_dict()
+        if district in lookup_map:
+            for category, weight in category_weights.items():
+                if not pd.isna(weight):
+                    if category in lookup_map[district]:
+                        lookup_map[district][category] += weight * num_geolocation_events
+                    else:
+                        lookup_map[district][category] = weight * num_geolocation_events
+        else:
+            lookup_map[district] = { category: weight * num_geolocation_events for category, weight in category_weights.items() if not pd.isna(weight)}
+    return lookup_map
+
+
+def synthetic_report(num_rows, num_slugs, seed=0):
+    rng = np.random.default_rng(seed)
+    slugs = np.array([f'location-{i}' for i in range(num_slugs)])
+    pathnames = np.concatenate([
+        np.array([f'/{path}' for path in category_paths] + ['/', '/about', '/locations', '/team/join']),
+        np.char.add('/locations/', slugs),
+    ])
+    pathname_index = np.where(
+        rng.random(num_rows) < 0.6,
+        rng.integers(len(category_paths) + 4, len(pathnames), num_rows),
+        rng.integers(0, len(category_paths) + 4, num_rows),
+    )
+    previous_params_routes = np.array(list(category_paths) + [None] * len(category_paths), dtype=object)
+    # typed like ga4.py's parsers build the report
+    category_df = pd.DataFrame({
+        'community': pd.array(np.where(rng.random(num_rows) < 0.1, None, rng.integers(101, 600, num_rows)), dtype='Int16'),
+        'neighborhood': pd.Categorical(np.array([f'neighborhood-{i}' for i in range(200)], dtype=object)[rng.integers(0, 200, num_rows)]),
+        'pathname': pd.Categorical(pathnames[pathname_index]),
+        'previousParamsRoute': pd.Categorical(previous_params_routes[rng.integers(0, len(previous_params_routes), num_rows)]),
+        'numGeolocationEvents': rng.integers(1, 50, num_rows).astype(np.float32),
+    })
+
+    # services for three quarters of the slugs, split over one to four categories
+    ratio_rows = []
+    for slug in slugs[: num_slugs * 3 // 4]:
+        categories = rng.choice(category_paths, size=rng.integers(1, 5), replace=False)
+        counts = rng.integers(1, 10, len(categories))
+        ratio_rows += [
+            {'slug': slug, 'category': category, 'count': count, 'percentage': count / counts.sum()}
+            for category, count in zip(categories, counts)
+        ]
+    return category_df, pd.DataFrame(ratio_rows).set_index('slug')
+
+
+def assert_same_result(expected, actual):
+    assert expected.keys() == actual.keys(), 'districts differ'
+    for district, categories in expected.items():
+        assert categories.keys() == actual[district].keys(), f'categories differ for {district}'
+        for category, value in categories.items():
+            assert math.isclose(value, actual[district][category], rel_tol=1e-9), f'{district}/{category}: {value} != {actual[district][category]}'
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--slugs', type=int, default=5_000)
+    parser.add_argument('--legacy-rows', type=int, default=10_000, help='rows to check against the legacy implementation, which is too slow for the full report')
+    args = parser.parse_args()
+
+    for geometry_type in (GeometryEnum.community, GeometryEnum.neighborhood):
+        category_df, ratio_df = synthetic_report(args.legacy_rows, args.slugs)
+        expected, legacy_seconds = timed(legacy_geolocation_category_weights, category_df, ratio_df, geometry_type)
+        actual, seconds = timed(geolocation_category_weights, category_df, ratio_df, geometry_type)
+        assert_same_result(expected, actual)
+        print(f'{geometry_type.value}: {args.legacy_rows} rows, legacy {legacy_seconds:.3f}s, vectorized {seconds:.3f}s, results match')
+
+        category_df, ratio_df = synthetic_report(args.rows, args.slugs)
+        _, seconds = timed(geolocation_category_weights, category_df, ratio_df, geometry_type)
+        print(f'{geometry_type.value}: {args.rows} rows, vectorized {seconds:.3f}s')
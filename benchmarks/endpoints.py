@@ -0,0 +1,223 @@
+"""
+Benchmarks every analytics endpoint end to end against local GA4 and
+Postgres stand-ins (see benchmarks/fakes.py).
+
+For each endpoint it measures:
+
+- cold: one request with empty GA4 report and rollup caches
+- warm: `--requests` requests, `--concurrency` at a time, giving latency
+  percentiles and throughput
+- peak: the peak memory traced by tracemalloc during one warm request
+
+Results are written as JSON under benchmarks/results/, named after the
+commit they were measured on, and `--compare` prints the change against an
+earlier run, exiting with status 1 when an endpoint got slower or bigger by
+more than `--threshold`.
+
+    python -m benchmarks.endpoints --rows 50000
+    python -m benchmarks.endpoints --compare benchmarks/results/6a326ff.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+# main reads its configuration on import
+os.environ.setdefault('API_USERNAME', 'benchmark')
+os.environ.setdefault('API_PASSWORD', 'benchmark')
+os.environ['GA4_CACHE_DIR'] = tempfile.mkdtemp(prefix='ga4-cache-')
+os.environ['ROLLUP_DIR'] = tempfile.mkdtemp(prefix='rollups-')
+
+import httpx
+
+import ga4
+import main
+from benchmarks.fakes import FakeAnalyticsClient, FakeDatabase
+from report_cache import ReportCache
+
+results_directory = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def endpoints(start_date, end_date):
+    """(name, url) of every request the benchmark makes."""
+    dates = f'start_date={start_date}&end_date={end_date}'
+    return [
+        ('sankey', f'/sankey?{dates}&geolocation_geometry_type=community&location_details_geometry_type=school'),
+        ('geolocation-service-category-analytics', f'/geolocation-service-category-analytics?{dates}&geometry_type=community'),
+        ('district-neighborhood-analytics[geolocation]', f'/district-neighborhood-analytics?{dates}&geometry_type=neighborhood&analytics_metric_type=geolocation'),
+        ('district-neighborhood-analytics[totalUsersForPagePath]', f'/district-neighborhood-analytics?{dates}&geometry_type=community&analytics_metric_type=totalUsersForPagePath'),
+        ('location-analytics[geolocation]', f'/location-analytics?{dates}&analytics_metric_type=geolocation'),
+        ('location-analytics[totalUsersForPagePath]', f'/location-analytics?{dates}&analytics_metric_type=totalUsersForPagePath'),
+        ('dashboard', f'/dashboard?{dates}&geometry_type=community&analytics_metric_type=geolocation'),
+        ('search-terms', f'/search-terms?{dates}'),
+        ('trends[community]', f'/trends?{dates}&geometry_type=community&analytics_metric_type=geolocation&bucket=week'),
+        ('trends[slug]', f'/trends?{dates}&analytics_metric_type=totalUsersForPagePath&rolling=7&top_k=100'),
+        ('geojson-geometries', '/geojson-geometries?geometry_type=neighborhood'),
+    ]
+
+
+def empty_caches():
+    """Points the GA4 report cache and the rollup store at new, empty directories."""
+    cache = ga4.report_cache
+    ga4.report_cache = ReportCache(
+        tempfile.mkdtemp(prefix='ga4-cache-'),
+        max_entries=cache.max_entries,
+        max_bytes=cache.max_bytes,
+        mutable_days=cache.mutable_days,
+        mutable_ttl=cache.mutable_ttl,
+    )
+    cache = main.daily_rollups.cache
+    main.daily_rollups.cache = ReportCache(
+        tempfile.mkdtemp(prefix='rollups-'),
+        max_entries=cache.max_entries,
+        max_bytes=cache.max_bytes,
+        mutable_days=cache.mutable_days,
+        mutable_ttl=cache.mutable_ttl,
+    )
+
+
+async def timed_request(client, url):
+    start = time.perf_counter()
+    response = await client.get(url)
+    seconds = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f'{url} returned {response.status_code}: {response.text[:200]}')
+    return seconds
+
+
+async def measure(client, url, num_requests, concurrency):
+    # geometries don't come from GA4, only their first request is cold
+    if not url.startswith('/geojson-geometries'):
+        empty_caches()
+    cold_seconds = await timed_request(client, url)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    await timed_request(client, url)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            return await timed_request(client, url)
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(limited() for _ in range(num_requests)))
+    wall_seconds = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {
+        'coldSeconds': cold_seconds,
+        'p50Seconds': float(p50),
+        'p90Seconds': float(p90),
+        'p99Seconds': float(p99),
+        'requestsPerSecond': num_requests / wall_seconds,
+        'peakBytes': peak_bytes,
+    }
+
+
+async def run(args):
+    end_date = datetime.date(2024, 6, 30)
+    start_date = end_date - datetime.timedelta(days=args.days - 1)
+    transport = httpx.ASGITransport(app=main.app)
+    auth = (os.environ['API_USERNAME'], os.environ['API_PASSWORD'])
+    results = {}
+    selected_endpoints = [
+        (name, url) for name, url in endpoints(start_date, end_date)
+        if not args.endpoint or any(selected in name for selected in args.endpoint)
+    ]
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', auth=auth, timeout=None) as client:
+        # the fake GA4 client generates each report on first request, which
+        # shouldn't count towards the first endpoint that needs it
+        for name, url in selected_endpoints:
+            if not url.startswith('/geojson-geometries'):
+                await timed_request(client, url)
+        for name, url in selected_endpoints:
+            results[name] = await measure(client, url, args.requests, args.concurrency)
+            print(format_result(name, results[name]), flush=True)
+    return results
+
+
+def format_result(name, result):
+    return (
+        f'{name:<55} cold {result["coldSeconds"] * 1000:8.1f}ms'
+        f'  p50 {result["p50Seconds"] * 1000:8.1f}ms  p90 {result["p90Seconds"] * 1000:8.1f}ms  p99 {result["p99Seconds"] * 1000:8.1f}ms'
+        f'  {result["requestsPerSecond"]:7.1f} req/s  peak {result["peakBytes"] / 2 ** 20:7.1f}MiB'
+    )
+
+
+def current_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{commit}-dirty' if dirty else commit
+
+
+def compare(previous, current, threshold):
+    """Prints the change of each endpoint's numbers, returns whether any got worse than the threshold."""
+    regressed = False
+    print(f'\ncompared to {previous["commit"]}:')
+    for name, result in current['endpoints'].items():
+        if name not in previous['endpoints']:
+            continue
+        before = previous['endpoints'][name]
+        changes = []
+        for key, higher_is_worse in (('coldSeconds', True), ('p50Seconds', True), ('p90Seconds', True), ('requestsPerSecond', False), ('peakBytes', True)):
+            change = result[key] / before[key] - 1 if before[key] else 0.0
+            worse = change > threshold if higher_is_worse else change < -threshold
+            regressed |= worse
+            changes.append(f'{key} {change:+7.1%}{" !" if worse else "  "}')
+        print(f'{name:<55} ' + '  '.join(changes))
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50_000, help='rows in every GA4 report')
+    parser.add_argument('--locations', type=int, default=2_000)
+    parser.add_argument('--days', type=int, default=30, help='length of the date range requested')
+    parser.add_argument('--requests', type=int, default=20, help='warm requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--ga4-latency', type=float, default=0.05, help='seconds per GA4 page')
+    parser.add_argument('--db-latency', type=float, default=0.005, help='seconds per query')
+    parser.add_argument('--endpoint', action='append', help='only benchmark endpoints whose name contains this')
+    parser.add_argument('--output', help='defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    ga4._client = FakeAnalyticsClient(args.rows, args.locations, latency=args.ga4_latency)
+    database = FakeDatabase(args.locations, latency=args.db_latency)
+    main.db.fetchall = database.fetchall
+
+    commit = current_commit()
+    current = {
+        'commit': commit,
+        'measuredAt': datetime.datetime.now().isoformat(timespec='seconds'),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'threshold')},
+        'endpoints': asyncio.run(run(args)),
+    }
+    output = args.output or os.path.join(results_directory, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(f'\nwrote {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous['parameters'] != current['parameters']:
+            print('warning: the runs used different parameters, numbers may not be comparable')
+        if compare(previous, current, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,237 @@
+"""
+Local stand-ins for GA4 and Postgres, so endpoints can be measured without
+credentials or the production database.
+
+FakeAnalyticsClient answers run_report like BetaAnalyticsDataClient, paging
+through a synthetic report of `num_rows` rows. FakeDatabase answers the
+queries main.py makes, recognized by fragments of their text, from a seeded
+synthetic city: a grid of neighborhoods and districts with locations
+scattered across it.
+"""
+import datetime
+import threading
+import time
+import types
+import zlib
+
+import numpy as np
+import shapely
+
+from main import category_paths, database_category_map
+
+# the synthetic city is a unit square, split into grids of polygons per geometry type
+district_grids = {
+    'community': 8,
+    'school': 6,
+    'congressional': 4,
+}
+neighborhood_grid = 12
+
+
+def grid_cells(size):
+    """(column, row, polygon) for a size x size grid over the unit square, with enough vertices to look like a boundary."""
+    cell = 1 / size
+    for column in range(size):
+        for row in range(size):
+            polygon = shapely.box(column * cell, row * cell, (column + 1) * cell, (row + 1) * cell)
+            yield column, row, shapely.segmentize(polygon, cell / 50)
+
+
+def district_id(geometry_type, column, row):
+    size = district_grids[geometry_type]
+    return (101 if geometry_type == 'community' else 1) + column * size + row
+
+
+def neighborhood_name(column, row):
+    return f'Neighborhood {column * neighborhood_grid + row}'
+
+
+def cell_of(value, size):
+    return np.minimum((value * size).astype(int), size - 1)
+
+
+class Value:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Row:
+    __slots__ = ('dimension_values', 'metric_values')
+
+    def __init__(self, dimension_values, metric_values):
+        self.dimension_values = [Value(value) for value in dimension_values]
+        self.metric_values = [Value(value) for value in metric_values]
+
+
+class FakeAnalyticsClient:
+    """
+    Synthetic GA4 reports of `num_rows` rows, served `limit` rows at a time.
+
+    Every page takes `latency` seconds, like a round trip to GA4. Reports are
+    generated once per request (without offset and limit) and seeded by it,
+    so the same request always gets the same rows.
+    """
+
+    def __init__(self, num_rows=50_000, num_locations=2_000, num_search_terms=500, latency=0.05, seed=0):
+        self.num_rows = num_rows
+        self.num_locations = num_locations
+        self.num_search_terms = num_search_terms
+        self.latency = latency
+        self.seed = seed
+        self.requests = 0
+        self._reports = {}
+        self._lock = threading.Lock()
+
+    def run_report(self, request):
+        time.sleep(self.latency)
+        key = (
+            tuple(dimension.name for dimension in request.dimensions),
+            tuple(metric.name for metric in request.metrics),
+            request.date_ranges[0].start_date,
+            request.date_ranges[0].end_date,
+            request.dimension_filter.filter.string_filter.value,
+        )
+        with self._lock:
+            self.requests += 1
+            if key not in self._reports:
+                self._reports[key] = self._generate(*key)
+            rows = self._reports[key]
+        return types.SimpleNamespace(rows=rows[request.offset:request.offset + request.limit], row_count=len(rows))
+
+    def _generate(self, dimensions, metrics, start_date, end_date, contains):
+        rng = np.random.default_rng([self.seed, zlib.crc32(repr((dimensions, metrics, start_date, end_date, contains)).encode())])
+        n = self.num_rows
+        start_date = datetime.date.fromisoformat(start_date)
+        num_days = (datetime.date.fromisoformat(end_date) - start_date).days + 1
+        x, y = rng.random(n), rng.random(n)
+        # location pages are requested far more often than the rest
+        location_ids = np.minimum(rng.zipf(1.3, n) - 1, self.num_locations - 1)
+        other_pages = np.array(['/', '/locations', '/about', '/team'] + [f'/{path}' for path in category_paths], dtype=object)
+        is_location_page = rng.random(n) < 0.7
+        page_paths = np.where(
+            is_location_page,
+            np.char.add('/locations/location-', location_ids.astype(str)).astype(object),
+            other_pages[rng.integers(0, len(other_pages), n)],
+        )
+        search_terms = np.array([f'search term {i}' for i in range(self.num_search_terms)], dtype=object)
+        searched = search_terms[np.minimum(rng.zipf(1.5, n) - 1, self.num_search_terms - 1)]
+        # the same term as users type it, in varying case and spacing
+        variants = rng.integers(0, 3, n)
+        searched = np.where(variants == 1, np.char.upper(searched.astype(str)).astype(object), searched)
+        searched = np.where(variants == 2, np.char.add(searched.astype(str), '+').astype(object), searched)
+        is_search_page = rng.random(n) < 0.4
+        page_paths_plus_query_strings = np.where(
+            is_search_page,
+            np.char.add('/locations?search=', np.char.replace(searched.astype(str), ' ', '+')).astype(object),
+            page_paths,
+        )
+        not_set = rng.random(n) < 0.1
+        columns = {
+            'date': np.array([
+                (start_date + datetime.timedelta(days=int(day))).strftime('%Y%m%d') for day in range(num_days)
+            ], dtype=object)[rng.integers(0, num_days, n)],
+            'pagePath': page_paths,
+            'pagePathPlusQueryString': page_paths_plus_query_strings,
+            'customEvent:pathname': page_paths,
+            'customEvent:previousParamsRoute': np.where(
+                rng.random(n) < 0.5, '(not set)', np.array(category_paths, dtype=object)[rng.integers(0, len(category_paths), n)],
+            ),
+            'customEvent:borough': np.array(['Manhattan', 'Bronx', 'Brooklyn', 'Queens', 'Staten Island'], dtype=object)[rng.integers(0, 5, n)],
+            'customEvent:neighborhood': np.where(not_set, '(not set)', [
+                neighborhood_name(column, row)
+                for column, row in zip(cell_of(x, neighborhood_grid), cell_of(y, neighborhood_grid))
+            ]),
+            'customEvent:zipCode': np.char.add('10', rng.integers(0, 500, n).astype(str)),
+        }
+        for geometry_type, ga4_name in (
+            ('community', 'customEvent:communityDistrict'),
+            ('congressional', 'customEvent:congressionalDistrict'),
+            ('school', 'customEvent:schoolDistrict'),
+        ):
+            size = district_grids[geometry_type]
+            ids = district_id(geometry_type, cell_of(x, size), cell_of(y, size)).astype(str)
+            columns[ga4_name] = np.where(not_set, '(not set)', ids)
+
+        keep = np.ones(n, dtype=bool)
+        if contains:
+            keep = np.char.find(columns['pagePathPlusQueryString'].astype(str), contains) >= 0
+        dimension_columns = [columns[name][keep].tolist() for name in dimensions]
+        metric_columns = [rng.integers(1, 20, n)[keep].astype(str).tolist() for _ in metrics]
+        return [Row(dimension_values, metric_values) for dimension_values, metric_values in zip(
+            zip(*dimension_columns),
+            zip(*metric_columns),
+        )]
+
+
+class FakeDatabase:
+    """
+    Answers main.py's queries from a seeded synthetic dataset.
+
+    Queries are recognized by fragments of their text, in order, so a new
+    query fails loudly instead of getting another query's rows. Every query
+    takes `latency` seconds.
+    """
+
+    def __init__(self, num_locations=2_000, latency=0.005, seed=0):
+        self.latency = latency
+        self.queries = 0
+        rng = np.random.default_rng(seed)
+        x, y = rng.random(num_locations), rng.random(num_locations)
+        updated_at = datetime.datetime(2024, 1, 1)
+        neighborhoods = zip(cell_of(x, neighborhood_grid), cell_of(y, neighborhood_grid))
+        districts = zip(*(
+            district_id(geometry_type, cell_of(x, district_grids[geometry_type]), cell_of(y, district_grids[geometry_type])).astype(str)
+            for geometry_type in ('school', 'congressional', 'community')
+        ))
+        self.locations = [
+            (
+                f'id-{i}', f'location-{i}', float(x[i]), float(y[i]),
+                None if i % 20 == 0 else f'Organization {i}',
+                neighborhood_name(*neighborhood), 'Manhattan', *district_ids, updated_at,
+            ) for i, neighborhood, district_ids in zip(range(num_locations), neighborhoods, districts)
+        ]
+        self.redirects = [(f'old-location-{i}', f'id-{i}') for i in range(0, num_locations, 10)]
+        categories = list(database_category_map)
+        self.service_categories = [
+            (f'location-{i}', categories[(i + j) % len(categories)], int(count))
+            for i in range(num_locations)
+            for j, count in enumerate(rng.integers(1, 6, rng.integers(1, 4)))
+        ]
+        self.neighborhoods = [
+            (neighborhood_name(column, row), 'Manhattan', polygon)
+            for column, row, polygon in grid_cells(neighborhood_grid)
+        ]
+        self.districts = [
+            (geometry_type, str(district_id(geometry_type, column, row)), polygon)
+            for geometry_type, size in district_grids.items()
+            for column, row, polygon in grid_cells(size)
+        ]
+        self.handlers = [
+            (('service_category',), lambda params: self.service_categories),
+            (('(select max(updated_at) from services)',), lambda params: [(updated_at, updated_at, 0, 0, len(self.redirects))]),
+            (('ST_AsGeoJSON', 'from nyc_neighborhood_geometries'), lambda params: [
+                (name, borough, shapely.to_geojson(polygon)) for name, borough, polygon in self.neighborhoods
+            ]),
+            (('ST_AsGeoJSON', 'from nyc_districts'), lambda params: [
+                (district, shapely.to_geojson(polygon)) for geometry_type, district, polygon in self.districts
+                if geometry_type == params['type']
+            ]),
+            (('ST_AsBinary(geometry) from nyc_neighborhood_geometries',), lambda params: [
+                (name, shapely.to_wkb(polygon)) for name, _, polygon in self.neighborhoods
+            ]),
+            (('ST_AsBinary(geometry) from nyc_districts',), lambda params: [
+                (geometry_type, district, shapely.to_wkb(polygon)) for geometry_type, district, polygon in self.districts
+            ]),
+            (('select slug, location_id from location_slug_redirects',), lambda params: self.redirects),
+            (('left join locations_geocoded_metadata',), lambda params: [] if params else self.locations),
+        ]
+
+    def fetchall(self, query, params=None):
+        time.sleep(self.latency)
+        self.queries += 1
+        for fragments, handler in self.handlers:
+            if all(fragment in query for fragment in fragments):
+                return handler(params)
+        raise ValueError(f'FakeDatabase has no rows recorded for {query}')
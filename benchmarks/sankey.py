@@ -0,0 +1,86 @@
+"""
+Benchmarks the /sankey aggregation against the row by row implementation it
+replaced, and checks both agree.
+
+    python -m benchmarks.sankey --rows 100000
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.category_weights import timed
+from main import GeometryEnum, format_value, geolocation_location_details_flows, nested_flows
+
+
+def legacy_sankey_lookups(joined_df, geolocation_geometry_type, location_details_geometry_type):
+    geolocation_lookup_map = {}
+    location_details_lookup_map = {}
+
+    filtered_joined_df = joined_df[
+        ~joined_df[f'geolocation_{geolocation_geometry_type.value}'].isna() & \
+            ~joined_df[f'location_details_{location_details_geometry_type.value}'].isna()
+    ]
+    for slug, row in filtered_joined_df.iterrows():
+        geolocation_value = format_value(row[f'geolocation_{geolocation_geometry_type.value}'], geolocation_geometry_type)
+        location_details_value = format_value(row[f'location_details_{location_details_geometry_type.value}'], location_details_geometry_type)
+        event_count = float(row['numGeolocationEvents'])
+
+        # populate geolocation_lookup_map
+        if geolocation_value in geolocation_lookup_map:
+            _location_details_lookup_map = geolocation_lookup_map[geolocation_value]
+            if location_details_value in _location_details_lookup_map:
+                _location_details_lookup_map[location_details_value] += event_count
+            else:
+                _location_details_lookup_map[location_details_value] = event_count
+        else:
+            geolocation_lookup_map[geolocation_value] = { location_details_value: event_count }
+
+        # populate location_details_lookup_map
+        if location_details_value in location_details_lookup_map:
+            _geolocation_lookup_map = location_details_lookup_map[location_details_value]
+            if geolocation_value in _geolocation_lookup_map:
+                _geolocation_lookup_map[geolocation_value] += event_count
+            else:
+                _geolocation_lookup_map[geolocation_value] = event_count
+        else:
+            location_details_lookup_map[location_details_value] = { geolocation_value: event_count }
+
+    return {
+        'geolocationLookup': geolocation_lookup_map,
+        'locationDetailsLookup': location_details_lookup_map
+    }
+
+
+def synthetic_joined_report(num_rows, seed=0):
+    """A GA4 report joined to location metadata, typed like the real one."""
+    rng = np.random.default_rng(seed)
+    neighborhoods = np.array([f'neighborhood-{i}' for i in range(200)], dtype=object)
+    return pd.DataFrame({
+        'geolocation_community': pd.array(rng.integers(101, 600, num_rows), dtype='Int16'),
+        'geolocation_neighborhood': pd.Categorical(neighborhoods[rng.integers(0, 200, num_rows)]),
+        'numGeolocationEvents': rng.integers(1, 50, num_rows).astype(np.float32),
+        # metadata of locations missing from the snapshot is NaN after the join
+        'location_details_school': np.where(rng.random(num_rows) < 0.05, np.nan, rng.integers(1, 33, num_rows)),
+        'location_details_neighborhood': np.where(rng.random(num_rows) < 0.05, None, neighborhoods[rng.integers(0, 200, num_rows)]),
+    }, index=pd.Index([f'location-{i}' for i in rng.integers(0, 5000, num_rows)], name='slug'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    args = parser.parse_args()
+
+    joined_df = synthetic_joined_report(args.rows)
+    for geolocation_geometry_type, location_details_geometry_type in (
+        (GeometryEnum.community, GeometryEnum.school),
+        (GeometryEnum.neighborhood, GeometryEnum.neighborhood),
+    ):
+        expected, legacy_seconds = timed(legacy_sankey_lookups, joined_df, geolocation_geometry_type, location_details_geometry_type)
+        actual, seconds = timed(
+            lambda *args: nested_flows(geolocation_location_details_flows(*args)),
+            joined_df, geolocation_geometry_type, location_details_geometry_type,
+        )
+        # event counts are whole numbers, so the sums are exact whatever the order
+        assert expected == actual, 'results differ'
+        print(f'{geolocation_geometry_type.value} -> {location_details_geometry_type.value}: {args.rows} rows, legacy {legacy_seconds:.3f}s, grouped {seconds:.3f}s, results match')
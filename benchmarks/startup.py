@@ -0,0 +1,59 @@
+"""
+Measures how long a worker takes to import main.py, the bulk of its startup,
+and which of main.py's imports the time goes to.
+
+Every run imports main in a fresh interpreter with `python -X importtime`,
+so nothing is already imported or compiled in memory. The modules listed are
+main.py's direct imports, with the time of everything they import in turn.
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times():
+    """{module: cumulative seconds} of one import of main, with 'main' for the whole of it."""
+    env = dict(os.environ, API_USERNAME=os.environ.get('API_USERNAME', 'benchmark'), API_PASSWORD=os.environ.get('API_PASSWORD', 'benchmark'))
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=repository, env=env, capture_output=True, text=True, check=True,
+    ).stderr
+    times = {}
+    # lines read "import time: <self us> | <cumulative us> | <indented module>"
+    in_main = False
+    for line in reversed(stderr.splitlines()):
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if name.strip() == 'main' and depth == 0:
+            in_main = True
+        elif depth == 0:
+            in_main = False
+        if in_main and depth <= 1:
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='direct imports of main to list')
+    args = parser.parse_args()
+
+    runs = defaultdict(list)
+    for _ in range(args.runs):
+        for module, seconds in import_times().items():
+            runs[module].append(seconds)
+    medians = {module: statistics.median(seconds) for module, seconds in runs.items()}
+    total = medians.pop('main')
+    print(f'import main: median {total:.3f}s over {args.runs} runs')
+    for module, seconds in sorted(medians.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f'  {module:<30} {seconds:.3f}s  {seconds / total:6.1%}')
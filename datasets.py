@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Dataset:
+    """
+    A value computed from the database and kept in process memory.
+
+    The value is loaded on first use and reloaded when it is older than
+    `max_age` seconds, or when `fingerprint()` (a cheap query, checked at most
+    every `fingerprint_interval` seconds) returns something different from what
+    it returned at the last load. Reloads swap the value in one assignment, and
+    while one is running other callers keep getting the previous value.
+
+    When a reload fails, e.g. while the database is unreachable, the error is
+    logged and the previous value served, and reloads are retried after
+    `retry_interval` seconds, doubling up to `max_retry_interval` while they
+    keep failing. Only the first load raises, there is nothing to serve yet.
+    """
+
+    def __init__(self, load, fingerprint=None, max_age=24 * 60 * 60, fingerprint_interval=60, retry_interval=30, max_retry_interval=10 * 60):
+        self.load = load
+        self.fingerprint = fingerprint
+        self.max_age = max_age
+        self.fingerprint_interval = fingerprint_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._lock = threading.Lock()
+        self._state = None
+        self._fingerprint_checked_at = 0
+        self._failures = 0
+        self._retry_at = 0
+        # bumped whenever the value is replaced, for datasets derived from this one
+        self.version = 0
+
+    @property
+    def loaded_at(self):
+        return self._state[0] if self._state else None
+
+    def refresh(self):
+        """Reloads the value unconditionally and returns it."""
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        fingerprint = self.fingerprint() if self.fingerprint else None
+        value = self.load()
+        self._state = (time.time(), fingerprint, value)
+        self._fingerprint_checked_at = time.time()
+        self.version += 1
+        return value
+
+    def _is_stale(self):
+        loaded_at, fingerprint, _ = self._state
+        now = time.time()
+        if now - loaded_at > self.max_age:
+            return True
+        if self.fingerprint and now - self._fingerprint_checked_at > self.fingerprint_interval:
+            self._fingerprint_checked_at = now
+            return self.fingerprint() != fingerprint
+        return False
+
+    def get(self):
+        state = self._state
+        if state is None:
+            with self._lock:
+                if self._state is None:
+                    return self._refresh()
+                return self._state[2]
+        if time.time() < self._retry_at or not self._lock.acquire(blocking=False):
+            # backing off after a failed reload, or another thread is
+            # reloading: serve the current value meanwhile
+            return state[2]
+        try:
+            value = self._update()
+        except Exception:
+            self._failures += 1
+            delay = min(self.retry_interval * 2 ** (self._failures - 1), self.max_retry_interval)
+            self._retry_at = time.time() + delay
+            logger.exception('Reloading %s failed, serving the previous value and retrying in %ss', self.load.__name__, delay)
+            return self._state[2]
+        finally:
+            self._lock.release()
+        self._failures = 0
+        return value
+
+    def _update(self):
+        if self._is_stale():
+            return self._refresh()
+        return self._state[2]
+
+    async def get_async(self):
+        return await asyncio.to_thread(self.get)
+
+
+class IncrementalDataset(Dataset):
+    """
+    A Dataset kept fresh by merging in what changed since the last check.
+
+    `load()` returns (value, watermark). Every `refresh_interval` seconds
+    `load_changes(watermark)` returns (changes, watermark), and when there are
+    changes `merge(value, changes)` returns the new value. Deletions aren't
+    visible to `load_changes`, so the value is still fully reloaded every
+    `max_age` seconds.
+    """
+
+    def __init__(self, load, load_changes, merge, max_age=60 * 60, refresh_interval=60, **kwargs):
+        super().__init__(load, max_age=max_age, **kwargs)
+        self.load_changes = load_changes
+        self.merge = merge
+        self.refresh_interval = refresh_interval
+
+    def _refresh(self):
+        value, watermark = self.load()
+        self._state = (time.time(), watermark, value)
+        self._fingerprint_checked_at = time.time()
+        self.version += 1
+        return value
+
+    def _update(self):
+        loaded_at, watermark, value = self._state
+        now = time.time()
+        if now - loaded_at > self.max_age:
+            return self._refresh()
+        if now - self._fingerprint_checked_at > self.refresh_interval:
+            self._fingerprint_checked_at = now
+            changes, watermark = self.load_changes(watermark)
+            if changes is not None:
+                value = self.merge(value, changes)
+                self.version += 1
+            self._state = (loaded_at, watermark, value)
+        return value
@@ -0,0 +1,120 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+from metrics import span
+
+
+class Database:
+    """
+    Pool of postgres connections shared by the endpoints.
+
+    Connections are checked out per query and health checked on checkout, so a
+    connection dropped by the server is replaced instead of taking the app down.
+    Queries are blocking: async code runs them on a worker thread, through
+    Dataset.get_async or asyncio.to_thread, to keep the event loop free while
+    postgres works.
+    """
+
+    def __init__(self, min_connections=1, max_connections=10, **connect_kwargs):
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.connect_kwargs = connect_kwargs
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Bounds the worker threads waiting on the pool, getconn raises instead of blocking
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(
+                        self.min_connections,
+                        self.max_connections,
+                        **self.connect_kwargs,
+                    )
+        return self._pool
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('select 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            conn = self.pool.getconn()
+            for _ in range(self.max_connections):
+                if self._is_healthy(conn):
+                    break
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+            broken = False
+            try:
+                yield conn
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn, close=broken or bool(conn.closed))
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                yield cur
+
+    def fetchall(self, query, params=None):
+        """Runs `query`, retrying once on a fresh connection if the connection dropped."""
+        for attempt in range(2):
+            try:
+                with self.cursor() as cur, span('db.query') as query_span:
+                    cur.execute(query, params)
+                    rows = cur.fetchall()
+                    query_span.rows = len(rows)
+                    return rows
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if attempt:
+                    raise
+
+    def ping(self):
+        """Whether postgres answers a query, opening the pool if it isn't open yet."""
+        try:
+            self.fetchall('select 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+
+db = Database(
+    min_connections=int(os.environ.get('DATABASE_POOL_MIN', 1)),
+    max_connections=int(os.environ.get('DATABASE_POOL_MAX', 10)),
+    dbname=os.environ.get('DATABASE_NAME'),
+    user=os.environ.get('DATABASE_USER'),
+    password=os.environ.get('DATABASE_PASSWORD'),
+    host=os.environ.get('DATABASE_HOST'),
+    port=os.environ.get('DATABASE_PORT'),
+    connect_timeout=int(os.environ.get('DATABASE_CONNECT_TIMEOUT', 5)),
+)
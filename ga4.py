@@ -1,103 +1,368 @@
+import asyncio
+import contextvars
 import datetime
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import (
-    DateRange,
-    Dimension,
-    Metric,
-    RunReportRequest,
-)
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import os
+import numpy as np
+import pandas as pd
+from metrics import span, traced
+from report_cache import ReportCache, date_range
+from search_terms import SpaceSaving, extract_search_term
+from singleflight import coalesced
+
+report_cache = ReportCache(
+    os.environ.get('GA4_CACHE_DIR', '.ga4_cache'),
+    max_entries=int(os.environ.get('GA4_CACHE_MAX_ENTRIES', 20000)),
+    max_bytes=int(os.environ.get('GA4_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+    mutable_days=int(os.environ.get('GA4_CACHE_MUTABLE_DAYS', 2)),
+    mutable_ttl=int(os.environ.get('GA4_CACHE_MUTABLE_TTL', 60 * 60)),
+)
+
+# GA4 returns at most 250k rows per request, larger reports are walked page by page
+page_size = int(os.environ.get('GA4_PAGE_SIZE', 100000))
+max_parallel_pages = int(os.environ.get('GA4_MAX_PARALLEL_PAGES', 4))
+
+# distinct search terms kept per report, the heaviest ones are always among them
+search_terms_capacity = int(os.environ.get('SEARCH_TERMS_CAPACITY', 10000))
+
+# bumped when the shape of cached reports changes, so stale entries are never read
+report_format_version = 3
+
+_client = None
+_client_lock = threading.Lock()
+_credentials_written = False
+
+def write_credentials():
+    """Writes GCP_CREDENTIALS to credentials.json for the GA4 client to read, once per process."""
+    global _credentials_written
+    if not _credentials_written and 'GCP_CREDENTIALS' in os.environ:
+        with open('credentials.json', 'w') as f:
+            f.write(os.environ['GCP_CREDENTIALS'])
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'credentials.json'
+    _credentials_written = True
+
+def get_client():
+    """Returns the GA4 client shared by every report, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # the SDK takes a good part of a worker's boot to import, so only
+                # workers that end up querying GA4 pay for it
+                from google.analytics.data_v1beta import BetaAnalyticsDataClient
+                write_credentials()
+                # Using a default constructor instructs the client to use the credentials
+                # specified in GOOGLE_APPLICATION_CREDENTIALS environment variable.
+                _client = BetaAnalyticsDataClient()
+    return _client
+
+# GA4's placeholders for a dimension without a value
+not_set_values = ['(not set)', '']
+
+def parse_int(values):
+    """District numbers, as a nullable int16 column."""
+    values = pd.Series(values, dtype=object)
+    return pd.to_numeric(values.mask(values.isin(not_set_values))).astype('Int16')
+
+def parse_str(values):
+    """Strings repeated across rows, as a categorical column."""
+    categorical = pd.Categorical(values)
+    return categorical.remove_categories(categorical.categories.intersection(not_set_values))
+
+def parse_date(values):
+    return pd.to_datetime(pd.Series(values, dtype=object), format='%Y%m%d')
+
+def keep_str(values):
+    return pd.Series(values, dtype=object)
+
+def concat_frames(frames):
+    """Concatenates report frames, unioning categories so categorical columns stay categorical."""
+    frames = list(frames)
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype) and len(frames) > 1:
+            categories = pd.Index(np.concatenate([frame[column].cat.categories.astype(object) for frame in frames])).unique()
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def iter_report_pages(**request_kwargs):
+    """
+    Runs a report page by page, yielding each page's rows in order.
 
-if 'GCP_CREDENTIALS' in os.environ:
-    credentials_json = os.environ.get('GCP_CREDENTIALS')
-    with open('credentials.json', 'w') as f:
-        f.write(credentials_json)
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'credentials.json'
+    After the first page tells how many rows there are, up to
+    `max_parallel_pages` of the remaining pages are requested at once.
+    Requests are given as plain dicts, converted to the SDK's messages here.
+    """
+    client = get_client()
+    from google.analytics.data_v1beta.types import RunReportRequest
 
-def parse_int(value):
-    return None if value == '(not set)' or value == '' else int(value)
+    def run_page(offset):
+        with span('ga4.run_report') as page_span:
+            response = client.run_report(RunReportRequest(**request_kwargs, offset=offset, limit=page_size))
+            page_span.rows = len(response.rows)
+        return response
+
+    first_page = run_page(0)
+    yield first_page.rows
+    offsets = iter(range(page_size, first_page.row_count, page_size))
+    with ThreadPoolExecutor(max_parallel_pages) as executor:
+        # pages run in the caller's context, so their spans count towards its request
+        submit = lambda offset: executor.submit(contextvars.copy_context().run, run_page, offset)
+        pending = deque(submit(offset) for offset in islice(offsets, max_parallel_pages))
+        while pending:
+            response = pending.popleft().result()
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                pending.append(submit(next_offset))
+            yield response.rows
+
+
+@traced('ga4.build_frame', rows=lambda rows, *_: len(rows))
+def rows_to_frame(rows, dimensions, metrics):
+    """Builds a typed frame column by column from a page of report rows."""
+    columns = {}
+    for i, (_, column, parse) in enumerate(dimensions):
+        columns[column] = parse([row.dimension_values[i].value for row in rows])
+    for i, (_, column, dtype) in enumerate(metrics):
+        columns[column] = np.array([row.metric_values[i].value for row in rows], dtype=dtype)
+    return pd.DataFrame(columns)
+
+
+def fetch_report(start_date: datetime.date, end_date: datetime.date, property_id, dimensions, metrics):
+    """
+    Runs a report and returns it as a DataFrame.
+
+    `dimensions` are (GA4 name, column, parser) and `metrics` are
+    (GA4 name, column, dtype) tuples, parsers convert a whole column of raw
+    values at once. Pages are converted as they arrive, so only one page of
+    GA4 rows is held at a time.
+    """
+    frames = [
+        rows_to_frame(rows, dimensions, metrics) for rows in iter_report_pages(
+            property=f"properties/{property_id}",
+            dimensions=[{"name": name} for name, _, _ in dimensions],
+            metrics=[{"name": name} for name, _, _ in metrics],
+            date_ranges=[{"start_date": str(start_date), "end_date": str(end_date)}],
+        )
+    ]
+    return concat_frames(frames)
+
+
+def split_by_date(df, start_date: datetime.date, end_date: datetime.date):
+    """Splits a report with a date column into {date: rows}, with an empty frame for days without rows."""
+    empty = df.iloc[:0].drop(columns='date')
+    frames_by_day = {day.date(): frame.drop(columns='date').reset_index(drop=True) for day, frame in df.groupby('date')}
+    return {day: frames_by_day.get(day, empty) for day in date_range(start_date, end_date)}
+
+
+@traced('aggregate.sum_by_dimensions', rows=lambda frames, *_: sum(len(frame) for frame in frames))
+def sum_by_dimensions(frames, metric):
+    """Concatenates reports and sums `metric` across rows that share every other column."""
+    df = concat_frames(frames)
+    dimensions = [column for column in df.columns if column != metric]
+    return df.groupby(dimensions, dropna=False, observed=True, sort=False, as_index=False)[metric].sum()
+
+
+def run_total_users_report(start_date: datetime.date, end_date: datetime.date, property_id, dimension, by_date=False):
+    return fetch_report(
+        start_date,
+        end_date,
+        property_id,
+        dimensions=[
+            (dimension, dimension, keep_str),  # Fetch the pagePath dimension
+        ] + ([
+            ("date", "date", parse_date),
+        ] if by_date else []),
+        metrics=[
+            ("totalUsers", "totalUsers", np.int32),
+        ],
+    )
 
-def parse_str(value):
-    return None if value == '(not set)' or value == '' else value
 
+@coalesced
 def fetch_total_users_for_page_path(start_date: datetime.date, end_date: datetime.date, property_id="403148122", dimension="pagePath"):
     """Runs a simple report on a Google Analytics 4 property."""
-    # TODO(developer): Uncomment this variable and replace with your
-    #  Google Analytics 4 property ID before running the sample.
-    # property_id = "YOUR-GA4-PROPERTY-ID"
+    # totalUsers counts distinct users, so it can't be summed across days: the
+    # whole range is cached as one entry, which expires like its end date does.
+    key = f'v{report_format_version}/{property_id}/total-users/{dimension}/{start_date.isoformat()}'
+    return report_cache.fetch(
+        key,
+        end_date,
+        end_date,
+        lambda *_: {end_date: run_total_users_report(start_date, end_date, property_id, dimension)},
+    )[end_date]
 
-    # Using a default constructor instructs the client to use the credentials
-    # specified in GOOGLE_APPLICATION_CREDENTIALS environment variable.
-    client = BetaAnalyticsDataClient()
 
-    request = RunReportRequest(
+def fetch_daily_report(key, start_date: datetime.date, end_date: datetime.date, run_report, refetch=False):
+    """
+    {date: rows} of a report broken down by date, each day cached on its own.
+
+    Only the days missing from the cache are requested with
+    `run_report(start_date, end_date)`, unless `refetch` is set: the whole
+    range is then run again, and replaces the cached days.
+    """
+    if not refetch:
+        return report_cache.fetch(key, start_date, end_date, run_report)
+    fetched = run_report(start_date, end_date)
+    rows_by_day = {}
+    for day in date_range(start_date, end_date):
+        rows_by_day[day] = fetched.get(day, [])
+        report_cache.put(key, day, rows_by_day[day])
+    return rows_by_day
+
+
+@coalesced
+def fetch_daily_total_users(start_date: datetime.date, end_date: datetime.date, property_id="403148122", dimension="pagePath", refetch=False):
+    """Users of each page on each day, as {date: rows}."""
+    key = f'v{report_format_version}/{property_id}/daily-total-users/{dimension}'
+    return fetch_daily_report(
+        key,
+        start_date,
+        end_date,
+        lambda span_start, span_end: split_by_date(run_total_users_report(span_start, span_end, property_id, dimension, by_date=True), span_start, span_end),
+        refetch,
+    )
+
+
+def run_search_terms_report(start_date: datetime.date, end_date: datetime.date, property_id, by_date=False):
+    """
+    Streams the users of search result pages into SpaceSaving sketches of their search terms.
+
+    Returns {date: sketch} when `by_date` is set, {None: sketch} otherwise. Only
+    pages with `search=` in their query string are requested, and each page of
+    rows is folded into the sketches as it arrives.
+    """
+    sketches = defaultdict(lambda: SpaceSaving(search_terms_capacity))
+    pages = iter_report_pages(
         property=f"properties/{property_id}",
-        dimensions=[
-            Dimension(name=dimension),  # Fetch the pagePath dimension
+        dimensions=[{"name": "pagePathPlusQueryString"}] + ([{"name": "date"}] if by_date else []),
+        metrics=[{"name": "totalUsers"}],
+        date_ranges=[{"start_date": str(start_date), "end_date": str(end_date)}],
+        dimension_filter={"filter": {
+            "field_name": "pagePathPlusQueryString",
+            "string_filter": {"match_type": "CONTAINS", "value": "search="},
+        }},
+    )
+    for rows in pages:
+        with span('search_terms.fold', rows=len(rows)):
+            for row in rows:
+                search_term = extract_search_term(row.dimension_values[0].value)
+                if search_term is None:
+                    continue
+                day = datetime.datetime.strptime(row.dimension_values[1].value, '%Y%m%d').date() if by_date else None
+                sketches[day].add(search_term, int(row.metric_values[0].value))
+    return sketches
+
+
+def sketch_to_frame(sketch):
+    """Users per search term from most to fewest, and how many of them may be overestimated (maxOverestimate)."""
+    top = sketch.top() if sketch is not None else []
+    return pd.DataFrame(
+        {
+            'totalUsers': np.array([count for _, count in top], dtype='int64'),
+            'maxOverestimate': np.array([sketch.errors[term] for term, _ in top], dtype='int64'),
+        },
+        index=pd.Index([term for term, _ in top], dtype=object, name='searchTerm'),
+    )
+
+
+@coalesced
+def fetch_search_term_users(start_date: datetime.date, end_date: datetime.date, property_id="403148122"):
+    """Users per normalized search term over the range, as a sketch_to_frame frame."""
+    # distinct users again, so the whole range is one entry like fetch_total_users_for_page_path
+    key = f'v{report_format_version}/{property_id}/search-terms-with-errors/{search_terms_capacity}/{start_date.isoformat()}'
+    return report_cache.fetch(
+        key,
+        end_date,
+        end_date,
+        lambda *_: {end_date: sketch_to_frame(run_search_terms_report(start_date, end_date, property_id).get(None))},
+    )[end_date]
+
+
+@coalesced
+def fetch_daily_search_term_users(start_date: datetime.date, end_date: datetime.date, property_id="403148122", refetch=False):
+    """Users per normalized search term on each day, as {date: sketch_to_frame frame}."""
+    key = f'v{report_format_version}/{property_id}/daily-search-terms-with-errors/{search_terms_capacity}'
+
+    def run_report(span_start, span_end):
+        sketches = run_search_terms_report(span_start, span_end, property_id, by_date=True)
+        return {day: sketch_to_frame(sketches.get(day)) for day in date_range(span_start, span_end)}
+
+    return fetch_daily_report(key, start_date, end_date, run_report, refetch)
+
+
+geolocation_dimensions = [
+    ("customEvent:borough", "borough", parse_str),
+    ("customEvent:communityDistrict", "community", parse_int),
+    ("customEvent:congressionalDistrict", "congressional", parse_int),
+    #("customEvent:googleBorough", "googleBorough", parse_str),
+    #("customEvent:googleNeighborhood", "googleNeighborhood", parse_str),
+    ("customEvent:neighborhood", "neighborhood", parse_str),
+    ("customEvent:pathname", "pathname", parse_str),
+    ("customEvent:schoolDistrict", "school", parse_int),
+    ("customEvent:zipCode", "zipCode", parse_str),
+]
+
+
+def run_geolocation_events_report(start_date: datetime.date, end_date: datetime.date, property_id, with_previous_params_route):
+    """Runs the geolocation events report broken down by date, returning {date: rows}."""
+    df = fetch_report(
+        start_date,
+        end_date,
+        property_id,
+        dimensions=geolocation_dimensions + ([
+            ("customEvent:previousParamsRoute", "previousParamsRoute", parse_str),
+        ] if with_previous_params_route else []) + [
+            ("date", "date", parse_date),
         ],
         metrics=[
-            Metric(name="totalUsers"),
+            ("keyEvents:geolocation", "numGeolocationEvents", np.float32),
         ],
-        date_ranges=[DateRange(start_date=str(start_date), end_date=str(end_date))],
     )
-    response = client.run_report(request)
+    return split_by_date(df, start_date, end_date)
 
-    return [{
-        dimension: row.dimension_values[0].value,
-        "totalUsers": int(row.metric_values[0].value),
-    } for row in response.rows]
+
+@coalesced
+def fetch_daily_geolocation_events(start_date: datetime.date, end_date: datetime.date, property_id="403148122", with_previous_params_route=False, refetch=False):
+    """Geolocation events of each day, as {date: rows}."""
+    # Geolocation events add up across days, so each day is cached on its own
+    # and only the days missing from the cache are requested from GA4.
+    key = f'v{report_format_version}/{property_id}/geolocation-events/{"with" if with_previous_params_route else "without"}-previous-params-route'
+    return fetch_daily_report(
+        key,
+        start_date,
+        end_date,
+        lambda span_start, span_end: run_geolocation_events_report(span_start, span_end, property_id, with_previous_params_route),
+        refetch,
+    )
 
 
+@coalesced
 def fetch_geolocation_events_from_ga4(start_date: datetime.date, end_date: datetime.date, property_id="403148122", with_previous_params_route=False):
     """Runs a simple report on a Google Analytics 4 property."""
-    # TODO(developer): Uncomment this variable and replace with your
-    #  Google Analytics 4 property ID before running the sample.
-    # property_id = "YOUR-GA4-PROPERTY-ID"
+    frames_by_day = fetch_daily_geolocation_events(start_date, end_date, property_id, with_previous_params_route)
+    return sum_by_dimensions([frames_by_day[day] for day in sorted(frames_by_day)], 'numGeolocationEvents')
 
-    # Using a default constructor instructs the client to use the credentials
-    # specified in GOOGLE_APPLICATION_CREDENTIALS environment variable.
-    client = BetaAnalyticsDataClient()
 
-    request = RunReportRequest(
-        property=f"properties/{property_id}",
-        dimensions=[
-            Dimension(name="customEvent:borough"),
-            Dimension(name="customEvent:communityDistrict"), 
-            Dimension(name="customEvent:congressionalDistrict"),
-            #Dimension(name="customEvent:googleBorough"),
-            #Dimension(name="customEvent:googleNeighborhood"),
-            Dimension(name="customEvent:neighborhood"),
-            Dimension(name="customEvent:pathname"),
-            Dimension(name="customEvent:schoolDistrict"),
-            Dimension(name="customEvent:zipCode"),
-        ] + ([
-            Dimension(name="customEvent:previousParamsRoute"),
-        ] if with_previous_params_route else []),
-        metrics=[
-            Metric(name="keyEvents:geolocation"),
-        ],
-        date_ranges=[DateRange(start_date=str(start_date), end_date=str(end_date))],
-    )
-    response = client.run_report(request)
-
-    return [{
-        "borough": parse_str(row.dimension_values[0].value),
-        "community": parse_int(row.dimension_values[1].value),
-        "congressional": parse_int(row.dimension_values[2].value),
-        #"googleBorough": parse_str(row.dimension_values[3].value),
-        #"googleNeighborhood": parse_str(row.dimension_values[4].value),
-        "neighborhood": parse_str(row.dimension_values[3].value),
-        "pathname": parse_str(row.dimension_values[4].value),
-        "school": parse_int(row.dimension_values[5].value),
-        "zipCode": parse_str(row.dimension_values[6].value),
-        "numGeolocationEvents": float(row.metric_values[0].value),
-        **({"previousParamsRoute": parse_str(row.dimension_values[7].value)} if with_previous_params_route else {})
-    } for row in response.rows]
+async def fetch_total_users_for_page_path_async(*args, **kwargs):
+    # The sync client is thread safe, running reports on worker threads keeps
+    # the event loop free and lets concurrent requests run reports in parallel
+    return await asyncio.to_thread(fetch_total_users_for_page_path, *args, **kwargs)
+
+
+async def fetch_geolocation_events_from_ga4_async(*args, **kwargs):
+    return await asyncio.to_thread(fetch_geolocation_events_from_ga4, *args, **kwargs)
+
+
+async def fetch_search_term_users_async(*args, **kwargs):
+    return await asyncio.to_thread(fetch_search_term_users, *args, **kwargs)
 
 if __name__ == '__main__':
     from datetime import date
-    from pprint import pprint
     results = fetch_geolocation_events_from_ga4(date(2024, 9, 12), date(2024,10, 2))
-    pprint(tuple(sorted(results, key=lambda x:x['numGeolocationEvents'])))
+    print(results.sort_values('numGeolocationEvents').to_string())
     import pdb
-    pdb.set_trace()
\ No newline at end of file
+    pdb.set_trace()
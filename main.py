@@ -1,11 +1,29 @@
+import time
+# before any other import, so the startup report counts them all
+import_started = time.perf_counter()
+
+import asyncio
+import logging
 import secrets
+from contextlib import asynccontextmanager
 from enum import Enum
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import datetime
-import psycopg2
 import os
-from ga4 import fetch_total_users_for_page_path, fetch_geolocation_events_from_ga4
+import ga4
+from ga4 import write_credentials, fetch_total_users_for_page_path_async, fetch_geolocation_events_from_ga4_async, fetch_search_term_users_async, fetch_daily_geolocation_events, fetch_daily_total_users, fetch_daily_search_term_users
+from db import db
+from datasets import Dataset, IncrementalDataset
+import metrics
+from metrics import span, startup_phase, traced
+from responses import EncodedPayload, frame_to_records, json_response, payload_response
+from spatial import PolygonIndex, assign_points
+from rollups import RollupStore
+from scheduler import LeaderLock, ResultsCache, Scheduler, gather_limited
+from singleflight import coalesced
+from report_cache import date_range
 import pandas as pd
 from json import loads
 import json
@@ -13,20 +31,12 @@ from fastapi.staticfiles import StaticFiles
 import re
 import numpy as np
 from functools import partial
-from urllib.parse import urlparse, parse_qs
 from typing import Annotated
 
 
-security = HTTPBasic()
+logger = logging.getLogger(__name__)
 
-# Connect to your postgres DB
-conn = psycopg2.connect(
-    dbname=os.environ.get('DATABASE_NAME'),
-    user=os.environ.get('DATABASE_USER'),
-    password=os.environ.get('DATABASE_PASSWORD'),
-    host=os.environ.get('DATABASE_HOST'),
-    port=os.environ.get('DATABASE_PORT'),
-)
+security = HTTPBasic()
 
 class GeometryEnum(str, Enum):
     community = "community"
@@ -38,21 +48,85 @@ class AnalyticsMetricEnum(str, Enum):
     geolocation = "geolocation"
     total_users_for_page_path = "totalUsersForPagePath"
 
-app = FastAPI()
+class SankeyFormatEnum(str, Enum):
+    nested = "nested"
+    sparse = "sparse"
 
-pattern = re.compile(r'POINT\((?P<longitude>-?\d+\.\d+) (?P<latitude>-?\d+\.\d+)\)')
-def parse_position(position_string):
-    m = pattern.match(position_string)
-    return {
-        'latitude': float(m.group('latitude')),
-        'longitude': float(m.group('longitude'))
-    }
+@asynccontextmanager
+async def lifespan(app):
+    with startup_phase('credentials'):
+        write_credentials()
+    # indexing the cache directories walks them, done here rather than at import
+    with startup_phase('caches'):
+        await asyncio.to_thread(ga4.report_cache.open)
+        await asyncio.to_thread(daily_rollups.cache.open)
+    # a worker that can't reach postgres yet still starts, /health/ready tells
+    # when it can serve, and the pool is opened again on the next query
+    with startup_phase('database'):
+        database_reachable = await asyncio.to_thread(db.ping)
+        if not database_reachable:
+            logger.warning('Postgres is unreachable, starting without it')
+    # loaded in bulk before serving, rather than by the first request needing it
+    if database_reachable:
+        with startup_phase('locations'):
+            try:
+                await location_snapshot.get_async()
+            except Exception:
+                logger.exception('Loading the location snapshot failed, it will be loaded on first use')
+    if warm_interval > 0:
+        warmer.start()
+    log_startup_report()
+    yield
+    warmer.stop()
+    db.close()
+
+def log_startup_report():
+    phases = {phase: metrics.startup_seconds.get(phase=phase) for phase in ('imports', 'credentials', 'caches', 'database', 'locations')}
+    # phases skipped, like loading locations without a database, aren't reported
+    phases = {phase: seconds for phase, seconds in phases.items() if seconds is not None}
+    # uvicorn's own logger, the only one it shows info messages of
+    logging.getLogger('uvicorn.error').info(
+        'Worker started in %.2fs (%s), see benchmarks/startup.py for the imports',
+        sum(phases.values()),
+        ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in phases.items()),
+    )
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.ServerTimingMiddleware)
 
 locations_re = re.compile(r'^/locations/(?P<slug>[^/]+)')
 
+def location_page_rows(ga4_report_df, page_path_key):
+    """Returns the report rows for /locations/<slug> pages, indexed by slug."""
+    path_components = ga4_report_df[page_path_key].str.split('/')
+    is_location_page = (path_components.str.len() == 3) & (path_components.str[1] == 'locations')
+    return ga4_report_df[is_location_page]\
+        .assign(slug=path_components[is_location_page].str[2])\
+        .set_index('slug')
+
 def format_value(value, geometry_enum: GeometryEnum):
     return value if geometry_enum.value == 'neighborhood' else int(value)
 
+def format_column(values, geometry_enum: GeometryEnum):
+    """format_value over a column, calling it once per distinct value."""
+    codes, uniques = pd.factorize(values)
+    return np.array([format_value(value, geometry_enum) for value in uniques], dtype=object)[codes]
+
+def requested_geometry_types(geometry_type: GeometryEnum | None, geometry_types: list[GeometryEnum] | None):
+    """The geometry types asked for, either one with `geometry_type` or any number with `geometry_types`."""
+    if (geometry_type is None) == (geometry_types is None):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Give either geometry_type or geometry_types",
+        )
+    return [geometry_type] if geometry_type is not None else list(dict.fromkeys(geometry_types))
+
+def by_geometry_type(geometry_type: GeometryEnum | None, geometry_types, maps):
+    """The map of `geometry_type` as is, or the maps of `geometry_types` keyed by geometry type."""
+    if geometry_type is not None:
+        return maps[0]
+    return { geometry_type.value: lookup_map for geometry_type, lookup_map in zip(geometry_types, maps) }
+
 category_paths = (
     'food',
     'shelters-housing',
@@ -79,53 +153,179 @@ def fetch_ratio_of_service_categories_for_locations():
     # find parent taxonomy of services
     # find percentage of services in parent taxonomy
     # these are the weights
-    with conn.cursor() as cur:
-        cur.execute('''
-            select slug, case when t.parent_name is not null then t.parent_name else t.name end as service_category, count(1) from 
-            (
-                select slug, location_id from location_slug_redirects
-                union 
-                select slug, id as location_id from locations
-            ) l
-            inner join service_at_locations sal on sal.location_id = l.location_id
-            inner join service_taxonomy st on st.service_id = sal.service_id
-            inner join taxonomies t on t.id = st.taxonomy_id
-            group by slug, service_category
-            order by slug
-        ''')
-        rows = cur.fetchall()
-        if not rows:
-            return pd.DataFrame()
-        df = pd.DataFrame([{'slug': row[0], 'category': database_category_map[row[1]], 'count': row[2]} for row in rows])
-        count_by_slug = df.groupby('slug').sum()
-        indexed_df = df.set_index(['slug'])
-        for slug, row in indexed_df.iterrows():
-            count = row['count']
-            total_count = count_by_slug.loc[slug]['count']
-            indexed_df.loc[slug, 'percentage'] = count / total_count
-        return indexed_df
-
-
-def row_to_category_weights(count_of_service_categories_df, x):
-    index, row = x
-    pathname = row['pathname']
-    previous_params_route = row['previousParamsRoute']
-    path_components = pathname.split('/')
-    first_component = path_components[1]
-    if first_component in category_paths:
-        return {'index' : index, first_component :  1 }
-    elif previous_params_route in category_paths:
-        return {'index' : index, previous_params_route: 1}
-    elif first_component == 'locations' and len(path_components) == 3:
-        # TODO extract the slug
-        slug = path_components[2]
-        row = count_of_service_categories_df[count_of_service_categories_df.index == slug][['category', 'percentage']].set_index('category')['percentage'].to_dict()
-        return {
-            'index': index,
-            **row
-        }
-
-    return {'index' : index, 'unknown': 1}
+    rows = db.fetchall('''
+        select slug, case when t.parent_name is not null then t.parent_name else t.name end as service_category, count(1) from 
+        (
+            select slug, location_id from location_slug_redirects
+            union 
+            select slug, id as location_id from locations
+        ) l
+        inner join service_at_locations sal on sal.location_id = l.location_id
+        inner join service_taxonomy st on st.service_id = sal.service_id
+        inner join taxonomies t on t.id = st.taxonomy_id
+        group by slug, service_category
+        order by slug
+    ''')
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame(rows, columns=['slug', 'category', 'count'])
+    df['category'] = df['category'].map(database_category_map.__getitem__)
+    df['percentage'] = df['count'] / df.groupby('slug')['count'].transform('sum')
+    return df.set_index('slug')
+
+
+def fetch_service_categories_fingerprint():
+    # changes whenever services, their taxonomies or the slugs pointing at them do
+    return db.fetchall('''
+        select
+            (select max(updated_at) from services),
+            (select max(updated_at) from taxonomies),
+            (select count(1) from service_taxonomy),
+            (select count(1) from service_at_locations),
+            (select count(1) from location_slug_redirects)
+    ''')
+
+
+# slug -> share of the location's services in each category, which rarely changes
+service_category_ratios = Dataset(
+    fetch_ratio_of_service_categories_for_locations,
+    fingerprint=fetch_service_categories_fingerprint,
+    max_age=int(os.environ.get('SERVICE_CATEGORY_RATIOS_MAX_AGE', 6 * 60 * 60)),
+)
+
+
+location_columns = [
+    'id', 'slug', 'longitude', 'latitude', 'organization_name',
+    'neighborhood', 'borough', 'school', 'congressional', 'community', 'updated_at',
+]
+
+
+def fetch_location_rows(updated_since=None):
+    rows = db.fetchall(f'''
+        select locations.id, locations.slug, ST_X(locations.position), ST_Y(locations.position), organizations.name,
+            locations_geocoded_metadata.neighborhood, locations_geocoded_metadata.borough, locations_geocoded_metadata.school,
+            locations_geocoded_metadata.congressional, locations_geocoded_metadata.community, locations.updated_at
+        from locations
+        left join organizations on locations.organization_id = organizations.id
+        left join locations_geocoded_metadata on locations.id = locations_geocoded_metadata.location_id
+        {'where locations.updated_at >= %s' if updated_since is not None else ''}
+    ''', (updated_since,) if updated_since is not None else None)
+    return pd.DataFrame(rows, columns=location_columns).drop_duplicates('id', keep='last').set_index('id')
+
+
+def index_locations_by_slug(locations_df):
+    """Indexes locations by their slug and by every slug that redirects to them."""
+    redirects_df = pd.DataFrame(
+        db.fetchall('select slug, location_id from location_slug_redirects'),
+        columns=['slug', 'id'],
+    )
+    locations_df = locations_df.reset_index()
+    redirected_df = redirects_df[~redirects_df['slug'].isin(locations_df['slug'])]\
+        .merge(locations_df.drop(columns='slug'), on='id')
+    return pd.concat([locations_df, redirected_df])\
+        .drop_duplicates('slug')\
+        .set_index('slug')\
+        .drop(columns='updated_at')
+
+
+def location_watermark(locations_df, watermark=None):
+    """
+    (latest updated_at, ids updated at that instant) of some locations, or `watermark` when there are none.
+
+    Changes are queried with updated_at >= the latest timestamp, so a row
+    updated in the same instant as the last one seen isn't missed, and the
+    ids already seen at that instant are skipped.
+    """
+    if locations_df.empty:
+        return watermark
+    updated_at = locations_df['updated_at'].max()
+    ids = frozenset(locations_df.index[locations_df['updated_at'] == updated_at])
+    if watermark is not None and watermark[0] == updated_at:
+        ids |= watermark[1]
+    return updated_at, ids
+
+
+def fetch_location_snapshot():
+    locations_df = fetch_location_rows()
+    return {
+        'locations': locations_df,
+        'by_slug': index_locations_by_slug(locations_df),
+    }, location_watermark(locations_df)
+
+
+def fetch_location_snapshot_changes(watermark):
+    # without a watermark the table was empty, anything in it now is a change
+    changed_df = fetch_location_rows(watermark[0] if watermark is not None else None)
+    if watermark is not None:
+        changed_df = changed_df[~((changed_df['updated_at'] == watermark[0]) & changed_df.index.isin(watermark[1]))]
+    if changed_df.empty:
+        return None, watermark
+    return changed_df, location_watermark(changed_df, watermark)
+
+
+def merge_location_snapshot(snapshot, changed_df):
+    locations_df = pd.concat([snapshot['locations'].drop(changed_df.index, errors='ignore'), changed_df])
+    return {
+        'locations': locations_df,
+        'by_slug': index_locations_by_slug(locations_df),
+    }
+
+
+# slug (including redirected slugs) -> location id, position, organization name and geocoded metadata
+location_snapshot = IncrementalDataset(
+    fetch_location_snapshot,
+    fetch_location_snapshot_changes,
+    merge_location_snapshot,
+    max_age=int(os.environ.get('LOCATION_SNAPSHOT_MAX_AGE', 60 * 60)),
+    refresh_interval=int(os.environ.get('LOCATION_SNAPSHOT_REFRESH_INTERVAL', 60)),
+)
+
+
+@traced('aggregate.category_events', rows=lambda category_df, *_: len(category_df))
+def geolocation_category_events(category_df, count_of_service_categories_df, geometry_types):
+    """
+    Resolves the service categories of geolocation events, once for all of `geometry_types`.
+
+    A row counts fully towards the category of its page (or of the page the
+    user came from), rows for a location page are split between categories by
+    the location's share of services in each one, and anything else is unknown.
+    Returns the events with their districts, and (events, category, weight)
+    rows with the same districts.
+    """
+    path_components = category_df['pathname'].str.split('/')
+    first_component = path_components.str[1]
+    category = first_component.where(first_component.isin(category_paths))
+    category = category.fillna(category_df['previousParamsRoute'].where(category_df['previousParamsRoute'].isin(category_paths)))
+    is_location_page = category.isna() & (first_component == 'locations') & (path_components.str.len() == 3)
+    category = category.where(category.notna() | is_location_page, 'unknown')
+
+    events = category_df[[geometry_type.value for geometry_type in geometry_types]]\
+        .assign(numGeolocationEvents=np.trunc(category_df['numGeolocationEvents']))
+    category_weights = events[~is_location_page].assign(category=category[~is_location_page], weight=1.0)
+    if not count_of_service_categories_df.empty:
+        slug_weights = count_of_service_categories_df[['category', 'percentage']].rename(columns={'percentage': 'weight'})
+        location_weights = events[is_location_page].assign(slug=path_components[is_location_page].str[2])\
+            .merge(slug_weights, left_on='slug', right_index=True)
+        category_weights = pd.concat([category_weights, location_weights.drop(columns='slug')])
+    return events, category_weights
+
+@traced('aggregate.category_weights', rows=lambda category_events, *_: len(category_events[1]))
+def district_category_weights(category_events, geometry_type: GeometryEnum):
+    """Sums geolocation events per district and service category, from geolocation_category_events."""
+    events, category_weights = category_events
+    category_weights = category_weights[category_weights[geometry_type.value].notna()]
+    weighted_events = (category_weights['weight'] * category_weights['numGeolocationEvents'])\
+        .groupby([category_weights[geometry_type.value], category_weights['category']], observed=True, sort=False).sum()
+
+    # districts whose rows all point at locations without services still get an entry
+    lookup_map = { format_value(district, geometry_type): {} for district in events[geometry_type.value].dropna().unique() }
+    for (district, category), value in weighted_events.items():
+        lookup_map[format_value(district, geometry_type)][category] = float(value)
+    return lookup_map
+
+def geolocation_category_weights(category_df, count_of_service_categories_df, geometry_type: GeometryEnum):
+    """Sums geolocation events per district and service category, for a single geometry type."""
+    return district_category_weights(geolocation_category_events(category_df, count_of_service_categories_df, [geometry_type]), geometry_type)
 
 
 def get_current_username(
@@ -149,301 +349,692 @@ def get_current_username(
         )
     return credentials.username
 
+def validate_date_range(start_date: datetime.date, end_date: datetime.date):
+    """Rejects ranges ending before they start, for every endpoint taking start_date and end_date."""
+    if start_date > end_date:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="start_date must not be after end_date",
+        )
 
-@app.get("/geolocation-service-category-analytics")
+
+@app.get("/geolocation-service-category-analytics", dependencies=[Depends(validate_date_range)])
 async def geolocation_service_category_analytics(
+    request: Request,
     start_date: datetime.date, 
     end_date: datetime.date, 
-    geometry_type: GeometryEnum, 
     username: Annotated[str, Depends(get_current_username)],
+    geometry_type: GeometryEnum | None = None,
+    geometry_types: Annotated[list[GeometryEnum] | None, Query()] = None,
 ):
-    count_of_service_categories_df = fetch_ratio_of_service_categories_for_locations()
-    category_df = pd.DataFrame(fetch_geolocation_events_from_ga4(start_date, end_date, with_previous_params_route=True))
-    # TODO: optimize the lookup
-    category_weights_df = pd.DataFrame(
-        list(
-            map(
-                partial(row_to_category_weights, count_of_service_categories_df), 
-                category_df.iterrows()
-            )
-        )
-    ).set_index('index')
-    category_df.join(category_weights_df).to_csv('category_weights_df.csv')
-    lookup_map = {}
-    for index, row in category_df.iterrows():
-        district = row[geometry_type.value]
-        if pd.isna(district):
-            continue
-        district = format_value(district, geometry_type)
-        num_geolocation_events = int(row['numGeolocationEvents'])
-        category_weights = category_weights_df.loc[index].to_dict()
-        if district in lookup_map:
-            for category, weight in category_weights.items():
-                    if not pd.isna(weight):
-                        if category in lookup_map[district]:
-                            lookup_map[district][category] += weight * num_geolocation_events 
-                        else:
-                            lookup_map[district][category] = weight * num_geolocation_events 
-
-            lookup_map[district][category] = num_geolocation_events
-        else:
-            lookup_map[district] = { category: weight * num_geolocation_events for category, weight in category_weights.items() if not pd.isna(weight)}
-    return lookup_map       
-
-
-@app.get("/sankey")
+    """Geolocation events per district and service category, for one geometry type, or keyed by geometry type for `geometry_types`."""
+    geometry_types = requested_geometry_types(geometry_type, geometry_types)
+    count_of_service_categories_df, category_df = await asyncio.gather(
+        service_category_ratios.get_async(),
+        fetch_geolocation_events_from_ga4_async(start_date, end_date, with_previous_params_route=True),
+    )
+    # categories are resolved once, then every geometry type is summed on its own thread
+    category_events = await asyncio.to_thread(geolocation_category_events, category_df, count_of_service_categories_df, geometry_types)
+    maps = await asyncio.gather(*(
+        asyncio.to_thread(district_category_weights, category_events, requested) for requested in geometry_types
+    ))
+    return json_response(request, by_geometry_type(geometry_type, geometry_types, maps))
+
+
+@traced('aggregate.sankey_join', rows=lambda ga4_report, *_: len(ga4_report))
+def sankey_join(ga4_report, location_metadata_by_slug_df, geolocation_geometry_type: GeometryEnum, location_details_geometry_type: GeometryEnum):
+    """Geolocation events on location pages, joined with the district of the location the page is about."""
+    geolocation_df = pd.DataFrame({
+        'slug': ga4_report['pathname'].str.extract(locations_re)['slug'],
+        f'geolocation_{geolocation_geometry_type.value}': ga4_report[geolocation_geometry_type.value],
+        'numGeolocationEvents': ga4_report['numGeolocationEvents'],
+    }).dropna().set_index('slug')
+    location_metadata_by_slug_df = location_metadata_by_slug_df[[location_details_geometry_type.value]].\
+        add_prefix(f'location_details_')
+    return geolocation_df.join(location_metadata_by_slug_df)
+
+
+@traced('aggregate.sankey_flows', rows=lambda joined_df, *_: len(joined_df))
+def geolocation_location_details_flows(joined_df, geolocation_geometry_type: GeometryEnum, location_details_geometry_type: GeometryEnum):
+    """Sums geolocation events per (geolocation district, location details district) pair."""
+    geolocation_column = f'geolocation_{geolocation_geometry_type.value}'
+    location_details_column = f'location_details_{location_details_geometry_type.value}'
+    joined_df = joined_df[joined_df[geolocation_column].notna() & joined_df[location_details_column].notna()]
+    return pd.Series(joined_df['numGeolocationEvents'].to_numpy(dtype=float)).groupby([
+        format_column(joined_df[geolocation_column], geolocation_geometry_type),
+        format_column(joined_df[location_details_column], location_details_geometry_type),
+    ]).sum()
+
+
+def matrix_to_lookup(matrix):
+    """{row: {column: value}} for the cells of a matrix that hold a value."""
+    return {
+        row: {column: float(value) for column, value in values.items() if not pd.isna(value)}
+        for row, values in matrix.iterrows()
+    }
+
+
+def nested_flows(flows):
+    """Both directions of the flows as nested lookups, from the flow matrix and its transpose."""
+    if flows.empty:
+        return {'geolocationLookup': {}, 'locationDetailsLookup': {}}
+    matrix = flows.unstack()
+    return {
+        'geolocationLookup': matrix_to_lookup(matrix),
+        'locationDetailsLookup': matrix_to_lookup(matrix.T),
+    }
+
+
+def sparse_flows(flows):
+    """Coordinate format: the ids of both axes, plus one (row, column, value) triple per pair."""
+    rows, geolocation_ids = pd.factorize(flows.index.get_level_values(0))
+    columns, location_details_ids = pd.factorize(flows.index.get_level_values(1))
+    return {
+        'geolocationIds': geolocation_ids.tolist(),
+        'locationDetailsIds': location_details_ids.tolist(),
+        'rows': rows.tolist(),
+        'columns': columns.tolist(),
+        'values': flows.to_numpy().tolist(),
+    }
+
+
+@app.get("/sankey", dependencies=[Depends(validate_date_range)])
 async def location_analytics(
+    request: Request,
     start_date: datetime.date, 
     end_date: datetime.date, 
     geolocation_geometry_type: GeometryEnum, 
     location_details_geometry_type: GeometryEnum,
     username: Annotated[str, Depends(get_current_username)],
+    format: SankeyFormatEnum = SankeyFormatEnum.nested,
 ):
-    ga4_report = fetch_geolocation_events_from_ga4(start_date, end_date)
-
-    geolocation_df = pd.DataFrame([
-        {
-            'slug': locations_re.match(row['pathname']).group('slug'), 
-            f'geolocation_{geolocation_geometry_type.value}': format_value(row[geolocation_geometry_type.value], geolocation_geometry_type),
-            'numGeolocationEvents': row['numGeolocationEvents']
-        } for row in ga4_report \
-            if locations_re.match(row['pathname']) and row[geolocation_geometry_type.value] is not None
-    ]).set_index('slug')
-    slugs = geolocation_df.index
-    with conn.cursor() as cur:
-        cur.execute('''
-            select slug, locations_geocoded_metadata.* from locations 
-            inner join locations_geocoded_metadata on locations.id = locations_geocoded_metadata.location_id
-            where slug in %s
-        ''', (tuple(slugs),))
-        location_metadata_by_slug_df = pd.DataFrame([ {
-            'slug': row[0],
-            'location_id': row[1],
-            'neighborhood': row[2],
-            'borough': row[3],
-            'school': row[4],
-            'congressional': row[5],
-            'community': row[6],
-        } for row in cur.fetchall() ])\
-            .set_index('slug')
-
-        location_metadata_by_slug_df = location_metadata_by_slug_df[[location_details_geometry_type.value]].\
-            add_prefix(f'location_details_')
-
-        joined_df = geolocation_df.join(location_metadata_by_slug_df)
-
-        geolocation_lookup_map = {}
-        location_details_lookup_map = {}
-
-        filtered_joined_df = joined_df[
-            ~joined_df[f'geolocation_{geolocation_geometry_type.value}'].isna() & \
-                ~joined_df[f'location_details_{location_details_geometry_type.value}'].isna()
-        ]
-        for slug, row in filtered_joined_df.iterrows():
-            geolocation_value = format_value(row[f'geolocation_{geolocation_geometry_type.value}'], geolocation_geometry_type)
-            location_details_value = format_value(row[f'location_details_{location_details_geometry_type.value}'], location_details_geometry_type)
-            event_count = row['numGeolocationEvents']
-
-            # populate geolocation_lookup_map
-            if geolocation_value in geolocation_lookup_map:
-                _location_details_lookup_map = geolocation_lookup_map[geolocation_value]
-                if location_details_value in _location_details_lookup_map:
-                    _location_details_lookup_map[location_details_value] += event_count
-                else:
-                    _location_details_lookup_map[location_details_value] = event_count
-            else:
-                geolocation_lookup_map[geolocation_value] = { location_details_value: event_count }
-
-            # populate location_details_lookup_map
-            if location_details_value in location_details_lookup_map:
-                _geolocation_lookup_map = location_details_lookup_map[location_details_value]
-                if geolocation_value in _geolocation_lookup_map:
-                    _geolocation_lookup_map[geolocation_value] += event_count
-                else:
-                    _geolocation_lookup_map[geolocation_value] = event_count
-            else:    
-                location_details_lookup_map[location_details_value] = { geolocation_value: event_count }
-
-
-        return {
-            'geolocationLookup': geolocation_lookup_map,
-            'locationDetailsLookup': location_details_lookup_map
-        }
-
-
-@app.get("/location-analytics")
+    ga4_report = await fetch_geolocation_events_from_ga4_async(start_date, end_date)
+    location_metadata_by_slug_df = (await location_snapshot.get_async())['by_slug']
+
+    # the join and aggregation are pandas work, kept off the event loop
+    joined_df = await asyncio.to_thread(sankey_join, ga4_report, location_metadata_by_slug_df, geolocation_geometry_type, location_details_geometry_type)
+    flows = await asyncio.to_thread(geolocation_location_details_flows, joined_df, geolocation_geometry_type, location_details_geometry_type)
+    format_flows = sparse_flows if format == SankeyFormatEnum.sparse else nested_flows
+    return json_response(request, await asyncio.to_thread(format_flows, flows))
+
+
+@traced('aggregate.location_page_totals', rows=lambda ga4_report_df, *_: len(ga4_report_df))
+def location_page_totals(ga4_report_df, page_path_key, count_key):
+    """Per-slug totals of a report's /locations/<slug> pages."""
+    return location_page_rows(ga4_report_df, page_path_key).groupby(level='slug', sort=False)[count_key].sum()
+
+def geolocation_district_rollup(ga4_report_df):
+    frames = []
+    for geometry_type in GeometryEnum:
+        totals = ga4_report_df.groupby(geometry_type.value, observed=True)['numGeolocationEvents'].sum()
+        frames.append(pd.DataFrame({
+            'geometryType': geometry_type.value,
+            'district': format_column(totals.index, geometry_type),
+            'numGeolocationEvents': totals.to_numpy(dtype=float),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+def slug_rollup(totals):
+    return pd.DataFrame({'slug': totals.index.to_numpy(dtype=object), 'value': totals.to_numpy(dtype=float)})
+
+@coalesced
+@traced('rollups.build_geolocation')
+def build_geolocation_rollups(start_date: datetime.date, end_date: datetime.date, refetch=False):
+    """Geolocation events per district and per location page, for every day of a span."""
+    geolocation_events = fetch_daily_geolocation_events(start_date, end_date, refetch=refetch)
+    return {
+        day: {
+            'districts': geolocation_district_rollup(geolocation_events[day]),
+            'slugs': slug_rollup(location_page_totals(geolocation_events[day], 'pathname', 'numGeolocationEvents')),
+        } for day in date_range(start_date, end_date)
+    }
+
+@coalesced
+@traced('rollups.build_page_path_users')
+def build_page_path_user_rollups(start_date: datetime.date, end_date: datetime.date, refetch=False):
+    """Users of each location page, for every day of a span."""
+    page_path_users = fetch_daily_total_users(start_date, end_date, refetch=refetch)
+    return {
+        day: {'slugs': slug_rollup(location_page_totals(page_path_users[day], 'pagePath', 'totalUsers'))}
+        for day in date_range(start_date, end_date)
+    }
+
+@coalesced
+@traced('rollups.build_search_terms')
+def build_search_term_rollups(start_date: datetime.date, end_date: datetime.date, refetch=False):
+    """Users per search term, for every day of a span."""
+    search_users = fetch_daily_search_term_users(start_date, end_date, refetch=refetch)
+    return {day: {'search_terms': search_users[day].reset_index()} for day in date_range(start_date, end_date)}
+
+rollup_builders = {
+    'geolocation': build_geolocation_rollups,
+    'page_path_users': build_page_path_user_rollups,
+    'search_terms': build_search_term_rollups,
+}
+# the rollup holding each metric's per-slug totals
+slug_rollups = {
+    AnalyticsMetricEnum.geolocation: 'geolocation',
+    AnalyticsMetricEnum.total_users_for_page_path: 'page_path_users',
+}
+
+daily_rollups = RollupStore(
+    os.environ.get('ROLLUP_DIR', '.rollups'),
+    rollup_builders,
+    mutable_days=int(os.environ.get('ROLLUP_MUTABLE_DAYS', 3)),
+    mutable_ttl=int(os.environ.get('ROLLUP_MUTABLE_TTL', 60 * 60)),
+)
+rollups_enabled = os.environ.get('ROLLUPS_ENABLED', 'true').lower() == 'true'
+# totalUsers counts distinct users, so a sum of daily rollups counts a user once
+# for every day they visited, unlike a single report over the whole range.
+# Off by default, these metrics are then answered from GA4 directly.
+rollup_user_metrics = os.environ.get('ROLLUP_USER_METRICS', 'false').lower() == 'true'
+rollup_backfill_days = int(os.environ.get('ROLLUP_BACKFILL_DAYS', 90))
+# rollups that ranges are read from, kept built ahead of requests
+backfilled_rollups = ['geolocation'] + (['page_path_users', 'search_terms'] if rollup_user_metrics else [])
+
+class SharedFetches:
+    """Starts each distinct fetch once per request, however many panels of it await the result."""
+
+    def __init__(self):
+        self._tasks = {}
+
+    def __call__(self, fetch, *args):
+        key = (fetch, args)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.ensure_future(fetch(*args))
+        return self._tasks[key]
+
+
+def uses_rollups(analytics_metric_type: AnalyticsMetricEnum):
+    if analytics_metric_type == AnalyticsMetricEnum.geolocation:
+        return rollups_enabled
+    return rollups_enabled and rollup_user_metrics
+
+async def fetch_rollup_geolocation_district_totals(start_date: datetime.date, end_date: datetime.date):
+    return await asyncio.to_thread(
+        daily_rollups.range_sum, 'geolocation', 'districts', start_date, end_date,
+        ('geometryType', 'district'), 'numGeolocationEvents',
+    )
+
+@traced('aggregate.geolocation_district_totals', rows=lambda ga4_report_df, *_: len(ga4_report_df))
+def sum_geolocation_events(ga4_report_df, geometry_type: GeometryEnum):
+    return ga4_report_df.groupby(geometry_type.value, observed=True)['numGeolocationEvents'].sum()
+
+async def fetch_geolocation_district_totals(fetches: SharedFetches, start_date: datetime.date, end_date: datetime.date, geometry_type: GeometryEnum):
+    """Geolocation events per district, from a source fetched once per request whatever the geometry types asked for."""
+    if uses_rollups(AnalyticsMetricEnum.geolocation):
+        totals = await fetches(fetch_rollup_geolocation_district_totals, start_date, end_date)
+        return totals[totals.index.get_level_values('geometryType') == geometry_type.value].droplevel('geometryType')
+    ga4_report_df = await fetches(fetch_geolocation_events_from_ga4_async, start_date, end_date)
+    return await asyncio.to_thread(sum_geolocation_events, ga4_report_df, geometry_type)
+
+async def fetch_location_page_totals(start_date: datetime.date, end_date: datetime.date, analytics_metric_type: AnalyticsMetricEnum):
+    if uses_rollups(analytics_metric_type):
+        totals = await asyncio.to_thread(
+            daily_rollups.range_sum, slug_rollups[analytics_metric_type], 'slugs', start_date, end_date, 'slug', 'value',
+        )
+        return totals.rename_axis('slug')
+    if analytics_metric_type == AnalyticsMetricEnum.geolocation:
+        ga4_report = await fetch_geolocation_events_from_ga4_async(start_date, end_date)
+        return location_page_totals(ga4_report, 'pathname', 'numGeolocationEvents')
+    ga4_report = await fetch_total_users_for_page_path_async(start_date, end_date)
+    return location_page_totals(ga4_report, 'pagePath', 'totalUsers')
+
+async def fetch_search_term_totals(start_date: datetime.date, end_date: datetime.date):
+    if rollups_enabled and rollup_user_metrics:
+        return await asyncio.to_thread(
+            daily_rollups.range_sum, 'search_terms', 'search_terms', start_date, end_date, 'searchTerm', ('totalUsers', 'maxOverestimate'),
+        )
+    return await fetch_search_term_users_async(start_date, end_date)
+
+
+# days in each of the windows dashboards are usually opened for, ending today
+warm_windows = [int(days) for days in os.environ.get('WARM_WINDOWS', '7,30,90').split(',') if days.strip()]
+warm_interval = int(os.environ.get('WARM_INTERVAL_SECONDS', 15 * 60))
+warm_concurrency = int(os.environ.get('WARM_CONCURRENCY', 2))
+
+# panels of the warm windows, recomputed in the background every warm_interval
+# shared by the workers, one of which computes them
+warmer_directory = os.environ.get('WARMER_DIR', '.warmer')
+warmed_results = ResultsCache(max_age=2 * warm_interval, path=os.path.join(warmer_directory, 'warmed-results.pickle'))
+
+def utc_today():
+    """Today in UTC, the end date the pages send by default."""
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+@traced('aggregate.location_analytics', rows=lambda slug_totals, *_: len(slug_totals))
+def location_analytics_records(slug_totals, location_snapshot_df):
+    database_df = location_snapshot_df[location_snapshot_df['organization_name'].notna()][['id', 'latitude', 'longitude', 'organization_name']]
+    # the busiest page counts towards the percentage even when its location is gone
+    total_count_of_users = float(slug_totals.max())
+    joined_df = slug_totals.rename('count').to_frame().join(database_df, how='inner')
+    result_df = pd.DataFrame({
+        'slug': joined_df.index.to_numpy(),
+        'totalUsers': joined_df['count'].astype('int64'),
+        'percentage': total_count_of_users / joined_df['count'].astype(float),
+        'locationId': joined_df['id'],
+        'organizationName': joined_df['organization_name'],
+        'latitude': joined_df['latitude'],
+        'longitude': joined_df['longitude'],
+    }, index=joined_df.index)
+    return frame_to_records(result_df)
+
+async def compute_location_analytics_panel(fetches: SharedFetches, start_date: datetime.date, end_date: datetime.date, analytics_metric_type: AnalyticsMetricEnum):
+    slug_totals, snapshot = await asyncio.gather(
+        fetches(fetch_location_page_totals, start_date, end_date, analytics_metric_type),
+        fetches(location_snapshot.get_async),
+    )
+    return await asyncio.to_thread(location_analytics_records, slug_totals, snapshot['by_slug'])
+
+async def location_analytics_panel(fetches: SharedFetches, start_date: datetime.date, end_date: datetime.date, analytics_metric_type: AnalyticsMetricEnum):
+    warmed = warmed_results.get(('location-analytics', start_date, end_date, analytics_metric_type))
+    if warmed is not None:
+        return warmed
+    return await compute_location_analytics_panel(fetches, start_date, end_date, analytics_metric_type)
+
+
+@app.get("/location-analytics", dependencies=[Depends(validate_date_range)])
 async def location_analytics(
+    request: Request,
     start_date: datetime.date, 
     end_date: datetime.date, 
     analytics_metric_type: AnalyticsMetricEnum,
     username: Annotated[str, Depends(get_current_username)],
 ):
+    return json_response(request, await location_analytics_panel(SharedFetches(), start_date, end_date, analytics_metric_type))
+
+
+def fetch_polygon_indexes():
+    """Loads the polygons of every geometry type into an in-memory spatial index."""
+    neighborhood_rows = db.fetchall('''
+        select neighborhood, ST_AsBinary(geometry) from nyc_neighborhood_geometries
+    ''')
+    district_rows = db.fetchall('''
+        select type, district_id, ST_AsBinary(geometry) from nyc_districts
+    ''')
+    polygon_indexes = {
+        GeometryEnum.neighborhood: PolygonIndex(
+            [neighborhood for neighborhood, _ in neighborhood_rows],
+            [geometry for _, geometry in neighborhood_rows],
+        ),
+    }
+    for geometry_type in GeometryEnum:
+        if geometry_type == GeometryEnum.neighborhood:
+            continue
+        rows = [(district_id, geometry) for type, district_id, geometry in district_rows if type == geometry_type.value]
+        polygon_indexes[geometry_type] = PolygonIndex(
+            [int(district_id) for district_id, _ in rows],
+            [geometry for _, geometry in rows],
+        )
+    return polygon_indexes
+
+
+# boundaries almost never change
+polygon_indexes = Dataset(fetch_polygon_indexes)
+
+
+def fetch_location_districts():
+    """Assigns every location to the polygons containing it, for every geometry type at once."""
+    locations_df = location_snapshot.get()['by_slug']
+    locations_df = locations_df[locations_df['longitude'].notna() & locations_df['latitude'].notna()]
+    slugs = locations_df.index
+    longitudes = locations_df['longitude']
+    latitudes = locations_df['latitude']
+    return {
+        geometry_type: assign_points(
+            polygon_index,
+            slugs,
+            longitudes,
+            latitudes,
+            'neighborhood' if geometry_type == GeometryEnum.neighborhood else 'district_id',
+        ) for geometry_type, polygon_index in polygon_indexes.get().items()
+    }
+
+
+def location_snapshot_version():
+    location_snapshot.get()
+    return location_snapshot.version
+
+
+# geometry type -> slug -> district (or neighborhood) containing the location
+location_districts = Dataset(fetch_location_districts, fingerprint=location_snapshot_version)
+
+
+@traced('aggregate.district_totals', rows=lambda totals, *_: len(totals))
+def district_totals(totals, geometry_type: GeometryEnum):
+    """{district: {totalUsers, percentage of the busiest district}} from per-district totals."""
+    result_df = pd.DataFrame({
+        'totalUsers': totals.astype('int64'),
+        'percentage': totals.astype(float) / float(totals.max()),
+    })
+    result_df.index = format_column(result_df.index, geometry_type)
+    return frame_to_records(result_df)
+
+
+@traced('aggregate.location_district_totals', rows=lambda slug_totals, *_: len(slug_totals))
+def location_district_totals(slug_totals, location_districts_by_geometry, geometry_type: GeometryEnum):
+    joined_df = slug_totals.rename('totalUsers').to_frame().join(location_districts_by_geometry[geometry_type])
+    district_column = 'neighborhood' if geometry_type == GeometryEnum.neighborhood else 'district_id'
+    return joined_df.groupby(district_column)['totalUsers'].sum()
+
+async def compute_district_analytics_panel(fetches: SharedFetches, start_date: datetime.date, end_date: datetime.date, geometry_type: GeometryEnum, analytics_metric_type: AnalyticsMetricEnum):
     if analytics_metric_type == AnalyticsMetricEnum.geolocation:
-        ga4_report = fetch_geolocation_events_from_ga4(start_date, end_date)
-        page_path_key = 'pathname'
-        count_of_users_key = 'numGeolocationEvents'
+        # in this case, we don't need to join anything to the database, because the geo information is already embedded in the GA4 event
+        totals = await fetch_geolocation_district_totals(fetches, start_date, end_date, geometry_type)
+        return await asyncio.to_thread(district_totals, totals, geometry_type)
     elif analytics_metric_type == AnalyticsMetricEnum.total_users_for_page_path:
-        ga4_report = fetch_total_users_for_page_path(start_date, end_date)
-        page_path_key = 'pagePath'
-        count_of_users_key = 'totalUsers'
-
-    slugs = [{
-        'slug': x[page_path_key].split('/')[2],
-        **x
-    } for x in ga4_report if len(x[page_path_key].split('/')) == 3 and x[page_path_key].split('/')[1] == 'locations']
-    slugs_df = pd.DataFrame(slugs).set_index('slug')
-    with conn.cursor() as cur:
-        cur.execute('''
-            select locations.id, slug, st_astext(position), organizations.name as organization_name from locations
-            inner join organizations on locations.organization_id = organizations.id
-            where slug in %s
-        ''', (tuple([s['slug'] for s in slugs]),))
-        database_df = pd.DataFrame([{'id': id, 'slug': slug, 'position': position, 'organization_name' : organization_name} for id, slug, position, organization_name in cur.fetchall()]).set_index('slug')
-        joined_df = slugs_df.join(database_df)
-        total_count_of_users = joined_df[count_of_users_key].max()
-        result = { 
-            r.name: {
-                'slug': r.name,
-                'totalUsers' : int(r[count_of_users_key]), 
-                'percentage' : total_count_of_users / r[count_of_users_key],
-                'locationId': r['id'], 
-                'organizationName': r['organization_name'],
-                **parse_position(r['position'])
-            } for r in joined_df.iloc if not pd.isna(r['id'])
-        }
-        print('result', json.dumps(result))
-        return result 
-
-
-@app.get("/district-neighborhood-analytics")
+        slug_totals, location_districts_by_geometry = await asyncio.gather(
+            fetches(fetch_location_page_totals, start_date, end_date, analytics_metric_type),
+            fetches(location_districts.get_async),
+        )
+        totals = await asyncio.to_thread(location_district_totals, slug_totals, location_districts_by_geometry, geometry_type)
+        return district_totals(totals, geometry_type)
+
+async def district_analytics_panel(fetches: SharedFetches, start_date: datetime.date, end_date: datetime.date, geometry_type: GeometryEnum, analytics_metric_type: AnalyticsMetricEnum):
+    warmed = warmed_results.get(('district-neighborhood-analytics', start_date, end_date, geometry_type, analytics_metric_type))
+    if warmed is not None:
+        return warmed
+    return await compute_district_analytics_panel(fetches, start_date, end_date, geometry_type, analytics_metric_type)
+
+
+@app.get("/district-neighborhood-analytics", dependencies=[Depends(validate_date_range)])
 async def analytics_data(
+    request: Request,
     start_date: datetime.date, 
     end_date: datetime.date, 
-    geometry_type: GeometryEnum, 
     analytics_metric_type: AnalyticsMetricEnum,
     username: Annotated[str, Depends(get_current_username)],
+    geometry_type: GeometryEnum | None = None,
+    geometry_types: Annotated[list[GeometryEnum] | None, Query()] = None,
 ):
-    if analytics_metric_type == AnalyticsMetricEnum.geolocation:
-        # in this case, we don't need to join anything to the database, because the geo information is already embedded in the GA4 event
-        ga4_report = fetch_geolocation_events_from_ga4(start_date, end_date)
-        ga4_report_df = pd.DataFrame(ga4_report)
-        df = ga4_report_df[["numGeolocationEvents", geometry_type.value]].set_index(geometry_type.value).groupby(geometry_type.value).sum()
-        total_count_of_events = df['numGeolocationEvents'].max()
-        return { 
-            r.name if geometry_type == GeometryEnum.neighborhood else int(r.name): {
-                'totalUsers' : int(r['numGeolocationEvents']),
-                'percentage' : r['numGeolocationEvents'] / total_count_of_events,
-            } for r in df.iloc
-        }
-    elif analytics_metric_type == AnalyticsMetricEnum.total_users_for_page_path:
-        ga4_report = fetch_total_users_for_page_path(start_date, end_date)
-        slugs = [{
-            'slug': x['pagePath'].split('/')[2],
-            **x
-        } for x in ga4_report if len(x['pagePath'].split('/')) == 3 and x['pagePath'].split('/')[1] == 'locations']
-        slugs_df = pd.DataFrame(slugs).set_index('slug')
-
-        with conn.cursor() as cur:
-            if geometry_type == GeometryEnum.neighborhood:
-                cur.execute('''
-                    select slug, neighborhood from locations
-                    inner join nyc_neighborhood_geometries on 
-                        ST_Contains(
-                            nyc_neighborhood_geometries.geometry, 
-                            ST_SetSRID(position,4326)
-                        )
-                    where slug in %s
-                ''', (tuple([s['slug'] for s in slugs]),))
-                database_df = pd.DataFrame([{'slug': slug, 'neighborhood': neighborhood} for slug, neighborhood in cur.fetchall()]).set_index('slug')
-                joined_df = slugs_df.join(database_df)
-                agg_result = joined_df[['neighborhood', 'totalUsers']].groupby('neighborhood').sum()
-                total_count_of_users = agg_result['totalUsers'].max()
-                print('total_count_of_users ', total_count_of_users )
-                return { 
-                    r.name: {
-                        'totalUsers' : int(r['totalUsers']),
-                        'percentage' : r['totalUsers'] / total_count_of_users,
-                    } for r in agg_result.iloc
-                }
-            else:
-                cur.execute('''
-                    select slug, district_id from locations
-                    inner join nyc_districts on 
-                        ST_Contains(
-                        nyc_districts.geometry, 
-                        ST_SetSRID(position,4326)
-                        )
-                    where type = %s 
-                ''', (geometry_type.value,))
-                database_df = pd.DataFrame([{'slug': slug, 'district_id': int(district_id)} for slug, district_id in cur.fetchall()]).set_index('slug')
-                joined_df = slugs_df.join(database_df)
-                agg_result = joined_df[['district_id', 'totalUsers']].groupby('district_id').sum()
-                total_count_of_users = agg_result['totalUsers'].max()
-                return { 
-                    int(r.name): {
-                        'totalUsers' : int(r['totalUsers']),
-                        'percentage' : r['totalUsers'] / total_count_of_users,
-                    } for r in agg_result.iloc 
-                }
+    """Users per district, for one geometry type, or keyed by geometry type for `geometry_types`."""
+    geometry_types = requested_geometry_types(geometry_type, geometry_types)
+    fetches = SharedFetches()
+    maps = await asyncio.gather(*(
+        district_analytics_panel(fetches, start_date, end_date, requested, analytics_metric_type)
+        for requested in geometry_types
+    ))
+    return json_response(request, by_geometry_type(geometry_type, geometry_types, maps))
+
+
+class DashboardPanelEnum(str, Enum):
+    location_analytics = "location-analytics"
+    district_neighborhood_analytics = "district-neighborhood-analytics"
+
+@app.get("/dashboard", dependencies=[Depends(validate_date_range)])
+async def dashboard(
+    request: Request,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    geometry_type: GeometryEnum,
+    analytics_metric_type: AnalyticsMetricEnum,
+    username: Annotated[str, Depends(get_current_username)],
+    panels: Annotated[list[DashboardPanelEnum], Query()] = list(DashboardPanelEnum),
+):
+    """
+    Several panels of the same date range in one response, {panel: the panel endpoint's response}.
+
+    GA4 reports and datasets used by more than one panel are fetched once, and
+    the panels are computed in parallel. Geometries aren't a panel: they don't
+    depend on the dates and /geojson-geometries serves them with an ETag.
+    """
+    fetches = SharedFetches()
+    panels = list(dict.fromkeys(panels))
+    panel_computations = {
+        DashboardPanelEnum.location_analytics: lambda: location_analytics_panel(fetches, start_date, end_date, analytics_metric_type),
+        DashboardPanelEnum.district_neighborhood_analytics: lambda: district_analytics_panel(fetches, start_date, end_date, geometry_type, analytics_metric_type),
+    }
+    results = await asyncio.gather(*(panel_computations[panel]() for panel in panels))
+    return json_response(request, {panel.value: result for panel, result in zip(panels, results)})
+
+def fetch_geojson_geometries(geometry_type: GeometryEnum, simplify_tolerance=None):
+    """Serializes the FeatureCollection for a geometry type straight from PostGIS' GeoJSON text."""
+    geometry_column = 'geometry' if simplify_tolerance is None else 'ST_SimplifyPreserveTopology(geometry, %(tolerance)s)'
+    if geometry_type == GeometryEnum.neighborhood:
+        rows = db.fetchall(f'''
+            select neighborhood, borough, ST_AsGeoJSON({geometry_column}) from nyc_neighborhood_geometries
+        ''', {'tolerance': simplify_tolerance})
+        features = [
+            (
+                { "id": neighborhood, "neighborhood": neighborhood, "borough": borough },
+                polygon_coordinates,
+            ) for neighborhood, borough, polygon_coordinates in rows
+        ]
+    else:
+        rows = db.fetchall(f'''
+            select district_id, ST_AsGeoJSON({geometry_column}) from nyc_districts
+            where type = %(type)s 
+        ''', {'tolerance': simplify_tolerance, 'type': geometry_type.value})
+        features = [
+            (
+                { "id": district_id, "districtId": district_id },
+                polygon_coordinates,
+            ) for district_id, polygon_coordinates in rows
+        ]
+    # ST_AsGeoJSON is NULL for a NULL geometry, which GeoJSON writes as null
+    body = '{"type": "FeatureCollection", "features": [' + ', '.join(
+        f'{{"type": "Feature", "properties": {json.dumps(jsonable_encoder(properties))}, "geometry": {polygon_coordinates or "null"}}}'
+        for properties, polygon_coordinates in features
+    ) + ']}'
+    return EncodedPayload(body.encode('utf8'))
+
+
+class SimplifyToleranceEnum(str, Enum):
+    """Simplification tolerances offered, in degrees, few enough to cache every variant."""
+    fine = "0.0001"
+    medium = "0.0005"
+    coarse = "0.001"
+    coarsest = "0.005"
+
+# (geometry type, simplify tolerance) -> serialized FeatureCollection
+geojson_geometries_cache = {}
+
+
+def get_geojson_geometries_dataset(geometry_type: GeometryEnum, simplify_tolerance: SimplifyToleranceEnum | None = None):
+    key = (geometry_type, simplify_tolerance)
+    if key not in geojson_geometries_cache:
+        tolerance = float(simplify_tolerance.value) if simplify_tolerance is not None else None
+        geojson_geometries_cache[key] = Dataset(partial(fetch_geojson_geometries, geometry_type, tolerance))
+    return geojson_geometries_cache[key]
+
 
 @app.get("/geojson-geometries")
-async def analytics_data(
+async def geojson_geometries(
+    request: Request,
     geometry_type: GeometryEnum,
     username: Annotated[str, Depends(get_current_username)],
+    simplify_tolerance: SimplifyToleranceEnum | None = None,
 ):
-    with conn.cursor() as cur:
-        if geometry_type == GeometryEnum.neighborhood:
-            cur.execute('''
-                select neighborhood, borough, ST_AsGeoJSON(geometry)::json from nyc_neighborhood_geometries
-            ''')
-            return {
-                "type": "FeatureCollection",
-                "features": [ { 
-                    "type": "Feature", 
-                    "properties": { 
-                        "id": neighborhood,
-                        "neighborhood": neighborhood, 
-                        "borough": borough,
-                    }, 
-                    "geometry": polygon_coordinates
-                } for neighborhood, borough, polygon_coordinates in cur.fetchall() ]
-            }
-        else:
-            cur.execute('''
-                select district_id, ST_AsGeoJSON(geometry)::json from nyc_districts
-                where type = %s 
-            ''', (geometry_type.value,))
-            return {
-                "type": "FeatureCollection",
-                "features": [ { 
-                    "type": "Feature", 
-                    "properties": { 
-                        "id": district_id,
-                        "districtId": district_id,
-                    }, 
-                    "geometry": polygon_coordinates
-                } for district_id, polygon_coordinates in cur.fetchall() ]
-            }
-
-@app.get("/search-terms")
+    payload = await get_geojson_geometries_dataset(geometry_type, simplify_tolerance).get_async()
+    return payload_response(request, payload)
+
+@app.get("/search-terms", dependencies=[Depends(validate_date_range)])
 async def search_terms(
+    request: Request,
     start_date: datetime.date, 
     end_date: datetime.date,
     username: Annotated[str, Depends(get_current_username)],
+    top_k: Annotated[int | None, Query(ge=1)] = None,
+    min_users: Annotated[int, Query(ge=0)] = 0,
+    with_error_bounds: bool = False,
+):
+    """
+    Users per search term, from most to fewest, for terms with at least `min_users` users.
+
+    Past SEARCH_TERMS_CAPACITY distinct terms, counts are estimates which may
+    be too high. When any returned count may be, the response has an
+    `Approximate-Counts: true` header, and with `with_error_bounds` every term
+    maps to {totalUsers, maxOverestimate}.
+    """
+    totals = await fetch_search_term_totals(start_date, end_date)
+    totals = totals[totals['totalUsers'] >= min_users]
+    totals = totals.nlargest(top_k, 'totalUsers') if top_k is not None else totals.sort_values('totalUsers', ascending=False)
+    headers = {'Approximate-Counts': 'true'} if (totals['maxOverestimate'] > 0).any() else None
+    if with_error_bounds:
+        return json_response(request, frame_to_records(totals.astype('int64')), headers=headers)
+    return json_response(request, dict(zip(totals.index.tolist(), totals['totalUsers'].astype('int64').tolist())), headers=headers)
+
+
+class TrendBucketEnum(str, Enum):
+    day = "day"
+    week = "week"
+    month = "month"
+
+# resampling rules, buckets are labeled by their first day: weeks start on mondays
+trend_bucket_rules = {
+    TrendBucketEnum.day: {'rule': 'D'},
+    TrendBucketEnum.week: {'rule': 'W-MON', 'label': 'left', 'closed': 'left'},
+    TrendBucketEnum.month: {'rule': 'MS'},
+}
+
+async def fetch_daily_rollups(rollup, start_date: datetime.date, end_date: datetime.date):
+    """A rollup's tables for every day of a range, from the store, or from GA4's daily reports when it's off."""
+    # with the store off, the builders read through the report cache
+    if rollups_enabled:
+        return await asyncio.to_thread(daily_rollups.days, rollup, start_date, end_date)
+    return await asyncio.to_thread(rollup_builders[rollup], start_date, end_date)
+
+@traced('aggregate.trend_series')
+def daily_series(days, analytics_metric_type: AnalyticsMetricEnum, geometry_type: GeometryEnum | None, location_districts_by_geometry):
+    """
+    (date, key, value) rows of a metric per day, keyed by slug, or by district when `geometry_type` is given.
+
+    Location pages' users are counted towards the districts the locations are in.
+    """
+    if geometry_type is not None and analytics_metric_type == AnalyticsMetricEnum.geolocation:
+        df = pd.concat([rollups['districts'].assign(date=day) for day, rollups in days.items()], ignore_index=True)
+        df = df[df['geometryType'] == geometry_type.value]
+        return pd.DataFrame({'date': df['date'], 'key': df['district'], 'value': df['numGeolocationEvents']})
+    df = pd.concat([rollups['slugs'].assign(date=day) for day, rollups in days.items()], ignore_index=True)
+    if geometry_type is None:
+        return pd.DataFrame({'date': df['date'], 'key': df['slug'], 'value': df['value']})
+    district_column = 'neighborhood' if geometry_type == GeometryEnum.neighborhood else 'district_id'
+    df = df.join(location_districts_by_geometry[geometry_type][district_column], on='slug', how='inner')
+    return pd.DataFrame({'date': df['date'], 'key': format_column(df[district_column], geometry_type), 'value': df['value']})
+
+@traced('aggregate.trend_table', rows=lambda series_df, *_: len(series_df))
+def trend_table(series_df, start_date: datetime.date, end_date: datetime.date, bucket: TrendBucketEnum, rolling: int | None, top_k: int | None):
+    """
+    Resamples daily series into buckets, as {buckets, keys, values} with values[i] the series of keys[i].
+
+    Series are ordered by their total over the range, largest first, and
+    smoothed by a mean over the last `rolling` buckets when it's given.
+    """
+    table = series_df.pivot_table(index='date', columns='key', values='value', aggfunc='sum', fill_value=0.0)
+    table.index = pd.DatetimeIndex(table.index)
+    # days without any event still count as buckets of zero
+    table = table.reindex(pd.date_range(start_date, end_date, freq='D'), fill_value=0.0)
+    table = table.resample(**trend_bucket_rules[bucket]).sum()
+    totals = table.sum()
+    keys = (totals.nlargest(top_k) if top_k is not None else totals.sort_values(ascending=False, kind='stable')).index
+    table = table[keys]
+    if rolling is not None:
+        table = table.rolling(rolling, min_periods=1).mean()
+    return {
+        'buckets': [bucket_start.date().isoformat() for bucket_start in table.index],
+        'keys': keys.tolist(),
+        'values': np.ascontiguousarray(table.to_numpy(dtype=float).T),
+    }
+
+@app.get("/trends", dependencies=[Depends(validate_date_range)])
+async def trends(
+    request: Request,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    analytics_metric_type: AnalyticsMetricEnum,
+    username: Annotated[str, Depends(get_current_username)],
+    geometry_type: GeometryEnum | None = None,
+    bucket: TrendBucketEnum = TrendBucketEnum.day,
+    rolling: Annotated[int | None, Query(ge=2)] = None,
+    top_k: Annotated[int | None, Query(ge=1)] = None,
 ):
-    ga4_report = fetch_total_users_for_page_path(start_date, end_date, dimension="pagePathPlusQueryString")
-    results = {}
-    for row in ga4_report:
-        total_users = int(row['totalUsers'])
-        parsed_url = urlparse(row["pagePathPlusQueryString"])
-        if parsed_url.query:
-            parsed_query = parse_qs(parsed_url.query)
-            if 'search' in parsed_query:
-                search_text = parsed_query['search'][0]
-                if search_text in results:
-                    results[search_text] += total_users
-                else:
-                    results[search_text] = total_users
-    return results
+    """
+    Time series of a metric per district, or per location page when no geometry type is given, in day, week or month buckets.
+
+    Every series comes from the same daily rollups, so one request replaces
+    one per bucket. totalUsers is summed over the days of a bucket, which
+    counts a user once per day they visited.
+    """
+    location_districts_by_geometry = None
+    if geometry_type is not None and analytics_metric_type == AnalyticsMetricEnum.total_users_for_page_path:
+        days, location_districts_by_geometry = await asyncio.gather(
+            fetch_daily_rollups(slug_rollups[analytics_metric_type], start_date, end_date),
+            location_districts.get_async(),
+        )
+    else:
+        days = await fetch_daily_rollups(slug_rollups[analytics_metric_type], start_date, end_date)
+    series_df = await asyncio.to_thread(daily_series, days, analytics_metric_type, geometry_type, location_districts_by_geometry)
+    return json_response(request, await asyncio.to_thread(trend_table, series_df, start_date, end_date, bucket, rolling, top_k))
+
+async def refresh_datasets():
+    """Reloads whichever of the database-backed datasets went stale, before a visitor has to."""
+    await asyncio.gather(location_snapshot.get_async(), service_category_ratios.get_async(), polygon_indexes.get_async())
+    await location_districts.get_async()
+    await asyncio.gather(*(
+        asyncio.to_thread(get_geojson_geometries_dataset(geometry_type).get) for geometry_type in GeometryEnum
+    ))
+
+async def refresh_rollups():
+    if rollups_enabled:
+        today = utc_today()
+        for rollup in backfilled_rollups:
+            await asyncio.to_thread(daily_rollups.backfill, rollup, today - datetime.timedelta(days=rollup_backfill_days), today)
+
+async def refresh_warmed_results():
+    """Recomputes the panels of every warm window, metric and geometry type, and swaps them in together."""
+    today = utc_today()
+    keys = []
+    computations = []
+    for days in warm_windows:
+        start_date = today - datetime.timedelta(days=days - 1)
+        # one set of fetches per window, shared by all of its panels
+        fetches = SharedFetches()
+        for analytics_metric_type in AnalyticsMetricEnum:
+            keys.append(('location-analytics', start_date, today, analytics_metric_type))
+            computations.append(compute_location_analytics_panel(fetches, start_date, today, analytics_metric_type))
+            for geometry_type in GeometryEnum:
+                keys.append(('district-neighborhood-analytics', start_date, today, geometry_type, analytics_metric_type))
+                computations.append(compute_district_analytics_panel(fetches, start_date, today, geometry_type, analytics_metric_type))
+    results = await gather_limited(computations, warm_concurrency)
+    failed = []
+    for key, result in zip(keys, results):
+        if isinstance(result, Exception):
+            logger.error('Warming %s failed', key, exc_info=result)
+            failed.append(key)
+    await asyncio.to_thread(warmed_results.replace, {key: result for key, result in zip(keys, results) if not isinstance(result, Exception)}, keep=failed)
+
+async def load_warmed_results():
+    """Swaps in the warmed results written by the leader, off the event loop so panels only read memory."""
+    await asyncio.to_thread(warmed_results.load_latest)
+
+# datasets are kept in each worker's memory, rollups and warmed results are
+# shared through files, so only one worker builds them
+warmer = Scheduler(warm_interval, leader_lock=LeaderLock(os.path.join(warmer_directory, 'leader.lock')))
+warmer.add('load_warmed_results', load_warmed_results)
+warmer.add('datasets', refresh_datasets)
+warmer.add('rollups', refresh_rollups, leader_only=True)
+warmer.add('warmed_results', refresh_warmed_results, leader_only=True)
+
+
+@app.get("/metrics")
+async def metrics_endpoint(username: Annotated[str, Depends(get_current_username)]):
+    """Stage timings and row counts, request latencies and response sizes, in Prometheus' text format."""
+    return Response(content=metrics.render(), media_type='text/plain; version=0.0.4')
+
+@app.get("/health/live")
+async def liveness():
+    """Answers as long as the worker's event loop does."""
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness(response: Response):
+    """Whether the worker can serve analytics, 503 while postgres doesn't answer."""
+    database = await asyncio.to_thread(db.ping)
+    if not database:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "ready" if database else "unavailable", "database": database}
 
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
+
+metrics.startup_seconds.set(time.perf_counter() - import_started, phase='imports')
@@ -0,0 +1,223 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from starlette.datastructures import MutableHeaders
+
+duration_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+row_buckets = (10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f'{self.name}{format_labels(labels)} {value}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f'{self.name}{format_labels(labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=duration_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> [observations per bucket, with the last one past every bucket], sum
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total) in self._series.items():
+                cumulative = 0
+                for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{format_labels(labels + (("le", bucket),))} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+                lines.append(f'{self.name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+
+stage_seconds = Histogram('analytics_stage_seconds', 'Time spent in each stage of handling a request.')
+stage_rows = Histogram('analytics_stage_rows', 'Rows handled by each run of a stage.', buckets=row_buckets)
+request_seconds = Histogram('analytics_request_seconds', 'Time to respond to a request, by route.')
+response_bytes = Counter('analytics_response_bytes_total', 'Bytes of serialized response bodies, by route.')
+response_encoding_seconds = Histogram('analytics_response_encoding_seconds', 'Time spent serializing and compressing response bodies, by route and step.')
+response_sent_bytes = Counter('analytics_response_sent_bytes_total', 'Bytes of response bodies sent after compression, by route and encoding.')
+startup_seconds = Gauge('analytics_startup_seconds', 'Time the worker spent in each phase of starting up.')
+
+registry = [stage_seconds, stage_rows, request_seconds, response_bytes, response_encoding_seconds, response_sent_bytes, startup_seconds]
+# callables returning exposition lines of values kept elsewhere, read when scraped
+collectors = []
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    for collect in collectors:
+        lines.extend(collect())
+    return '\n'.join(lines) + '\n'
+
+
+class Span:
+    __slots__ = ('stage', 'rows', 'seconds')
+
+    def __init__(self, stage, rows=None):
+        self.stage = stage
+        self.rows = rows
+        self.seconds = None
+
+
+# spans finished while handling the current request, None outside of one
+_request_spans = contextvars.ContextVar('request_spans', default=None)
+
+
+def start_request():
+    """Starts collecting the spans of the request handled in the current context, returning their list."""
+    spans = []
+    _request_spans.set(spans)
+    return spans
+
+
+@contextmanager
+def span(stage, rows=None):
+    """
+    Times the body as `stage`, recording it into the histograms and into the current request's spans.
+
+    Set `rows` on the yielded span when the count is only known at the end.
+    """
+    current = Span(stage, rows)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - start
+        stage_seconds.observe(current.seconds, stage=stage)
+        if current.rows is not None:
+            stage_rows.observe(current.rows, stage=stage)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append(current)
+
+
+@contextmanager
+def startup_phase(phase):
+    """Times the body as `phase` of starting the worker, reported by startup_seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_seconds.set(time.perf_counter() - start, phase=phase)
+
+
+def traced(stage, rows=None):
+    """Decorates a function to run in a span, `rows(*args, **kwargs)` counting the rows it's given."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, rows(*args, **kwargs) if rows else None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def server_timing(spans, total_seconds=None):
+    """A Server-Timing header value with the time and rows of each stage, summed over its runs."""
+    stages = {}
+    for current in spans:
+        seconds, runs, rows = stages.get(current.stage, (0.0, 0, None))
+        if current.rows is not None:
+            rows = (rows or 0) + current.rows
+        stages[current.stage] = (seconds + current.seconds, runs + 1, rows)
+    entries = []
+    for stage, (seconds, runs, rows) in stages.items():
+        description = f'{runs} run{"s" if runs > 1 else ""}' + (f', {rows} rows' if rows is not None else '')
+        entries.append(f'{stage};dur={seconds * 1000:.2f};desc="{description}"')
+    if total_seconds is not None:
+        entries.append(f'total;dur={total_seconds * 1000:.2f}')
+    return ', '.join(entries)
+
+
+class ServerTimingMiddleware:
+    """
+    Times every request by route, and reports the stages it went through in a Server-Timing header.
+
+    A plain ASGI middleware, so requests aren't run in an extra task and their
+    spans are collected in the context the endpoint runs in.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        spans = start_request()
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                seconds = time.perf_counter() - start
+                route = scope.get('route')
+                request_seconds.observe(seconds, route=route.path if route is not None and route.path else 'static')
+                MutableHeaders(scope=message).append('Server-Timing', server_timing(spans, seconds))
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
@@ -0,0 +1,199 @@
+import datetime
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+def date_range(start_date: datetime.date, end_date: datetime.date):
+    day = start_date
+    while day <= end_date:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def contiguous_spans(days):
+    """Groups sorted dates into (start_date, end_date) spans of consecutive days."""
+    spans = []
+    for day in days:
+        if spans and spans[-1][1] + datetime.timedelta(days=1) == day:
+            spans[-1][1] = day
+        else:
+            spans.append([day, day])
+    return [tuple(span) for span in spans]
+
+
+class ReportCache:
+    """
+    Persistent cache of GA4 report results, partitioned by report key and day.
+
+    Every entry is one pickle file holding the rows of a single day and when
+    they were fetched. GA4 may update a day until `mutable_days` days after
+    it, so rows fetched before then expire after `mutable_ttl` seconds, and
+    only rows fetched later never expire. When the directory grows past
+    `max_entries` files or `max_bytes` bytes, the least recently used entries
+    are evicted.
+
+    The directory may be shared by several processes: entries written by
+    another one are read from disk, and every `rescan_interval` seconds the
+    index is rebuilt from the files' modification times, which reads keep
+    up to date, so eviction applies to the directory as a whole.
+
+    The directory is indexed by `open()`, on first use unless called before.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_entries=20000,
+        max_bytes=512 * 1024 * 1024,
+        mutable_days=2,
+        mutable_ttl=60 * 60,
+        rescan_interval=5 * 60,
+    ):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.mutable_days = mutable_days
+        self.mutable_ttl = mutable_ttl
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        # path -> size in bytes, ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._scanned_at = 0
+        self._opened = False
+        self._open_lock = threading.Lock()
+
+    def open(self):
+        """Creates and indexes the directory, once."""
+        if self._opened:
+            return
+        with self._open_lock:
+            if not self._opened:
+                self._load_index()
+                self._opened = True
+
+    def _load_index(self):
+        """Rebuilds the index from the files on disk, ordered by when they were last used by any process."""
+        os.makedirs(self.directory, exist_ok=True)
+        scanned_at = time.time()
+        entries = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.pickle'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        index = OrderedDict((path, size) for _, path, size in sorted(entries))
+        with self._lock:
+            self._entries = index
+            self._total_bytes = sum(index.values())
+            self._scanned_at = scanned_at
+
+    def _path(self, key, day: datetime.date):
+        return os.path.join(self.directory, key, f'{day.isoformat()}.pickle')
+
+    def is_final(self, day: datetime.date, fetched_at):
+        """Whether GA4 had stopped updating `day` when its rows were fetched."""
+        return datetime.date.fromtimestamp(fetched_at) >= day + datetime.timedelta(days=self.mutable_days)
+
+    def get(self, key, day: datetime.date):
+        """Returns the cached rows for `day`, or None if missing or expired."""
+        self.open()
+        path = self._path(key, day)
+        # read outside the lock, so reads of different entries don't wait on each other
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                fetched_at, rows = pickle.load(f)
+        except FileNotFoundError:
+            # never written, or evicted by another process
+            with self._lock:
+                self._total_bytes -= self._entries.pop(path, 0)
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self._lock:
+                self._remove(path)
+            return None
+        if not self.is_final(day, fetched_at) and time.time() - fetched_at > self.mutable_ttl:
+            with self._lock:
+                self._remove(path)
+            return None
+        with self._lock:
+            # entries written by another process join the index when first read
+            self._total_bytes += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return rows
+
+    def remove(self, key, day: datetime.date):
+        self.open()
+        with self._lock:
+            self._remove(self._path(key, day))
+
+    def put(self, key, day: datetime.date, rows):
+        self.open()
+        path = self._path(key, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((time.time(), rows), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            rescan = time.time() - self._scanned_at > self.rescan_interval
+            if rescan:
+                # claimed here, so only one thread rescans
+                self._scanned_at = time.time()
+        if rescan:
+            self._load_index()
+        with self._lock:
+            self._total_bytes -= self._entries.pop(path, 0)
+            self._entries[path] = size
+            self._total_bytes += size
+            self._evict()
+
+    def _remove(self, path):
+        self._total_bytes -= self._entries.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+            path = next(iter(self._entries))
+            self._remove(path)
+
+    def fetch(self, key, start_date: datetime.date, end_date: datetime.date, fetch_days):
+        """
+        Returns {day: rows} for every day between start_date and end_date.
+
+        Days missing from the cache are fetched with `fetch_days(start_date, end_date)`,
+        one call per contiguous span of missing days, which must return {day: rows}
+        for that span. Days the fetcher returns nothing for are cached as empty.
+        """
+        rows_by_day = {}
+        missing_days = []
+        for day in date_range(start_date, end_date):
+            rows = self.get(key, day)
+            if rows is None:
+                missing_days.append(day)
+            else:
+                rows_by_day[day] = rows
+        for span_start, span_end in contiguous_spans(missing_days):
+            fetched = fetch_days(span_start, span_end)
+            for day in date_range(span_start, span_end):
+                rows = fetched.get(day, [])
+                self.put(key, day, rows)
+                rows_by_day[day] = rows
+        return rows_by_day
@@ -0,0 +1,119 @@
+import gzip
+import hashlib
+import json
+
+import numpy as np
+from fastapi import Request, Response
+
+from metrics import response_bytes, response_encoding_seconds, response_sent_bytes, span, traced
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# bodies smaller than this aren't worth compressing
+min_compress_size = 1024
+# payloads are compressed on the request that misses their cache: brotli's
+# default quality 11 takes seconds on a megabyte of GeoJSON, 5 a few tens of
+# milliseconds for a slightly larger body
+brotli_quality = 5
+
+
+class EncodedPayload:
+    """A response body serialized once and kept alongside its compressed encodings."""
+
+    def __init__(self, body: bytes, media_type='application/json'):
+        self.body = body
+        self.media_type = media_type
+        self.etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+        self.encodings = {'gzip': gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(body, quality=brotli_quality)
+
+
+def accepted_encodings(request: Request):
+    encodings = set()
+    for part in request.headers.get('accept-encoding', '').split(','):
+        name, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def etag_matches(request: Request, etag):
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # weak comparison, the same body is served under several encodings
+    opaque_tag = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == opaque_tag for tag in if_none_match.split(','))
+
+
+def payload_response(request: Request, payload: EncodedPayload, max_age=60 * 60):
+    """Serves a precompressed payload, or a 304 when the client already has it."""
+    headers = {
+        'ETag': payload.etag,
+        'Cache-Control': f'private, max-age={max_age}',
+        'Vary': 'Accept-Encoding',
+    }
+    if etag_matches(request, payload.etag):
+        return Response(status_code=304, headers=headers)
+    encodings = accepted_encodings(request)
+    for encoding in ('br', 'gzip'):
+        if encoding in encodings and encoding in payload.encodings:
+            return Response(
+                content=payload.encodings[encoding],
+                media_type=payload.media_type,
+                headers={**headers, 'Content-Encoding': encoding},
+            )
+    return Response(content=payload.body, media_type=payload.media_type, headers=headers)
+
+
+def _default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(content) -> bytes:
+    """Encodes to JSON with orjson when it's installed, including NumPy scalars and arrays and int keys."""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, separators=(',', ':')).encode('utf8')
+
+
+@traced('serialize.records', rows=len)
+def frame_to_records(df):
+    """{index: {column: value}}, converting whole columns to Python scalars with tolist()."""
+    columns = list(df.columns)
+    rows = zip(*(df[column].tolist() for column in columns))
+    return { key: dict(zip(columns, row)) for key, row in zip(df.index.tolist(), rows) }
+
+
+def json_response(request: Request, content, status_code=200, headers=None):
+    """Encodes content once, gzips it when the client accepts it, and counts the time and bytes per endpoint."""
+    with span('serialize') as serialize_span:
+        body = dumps(content)
+    # the stage histograms only know the step, these tell the endpoints apart
+    response_encoding_seconds.observe(serialize_span.seconds, endpoint=request.url.path, step='serialize')
+    headers = {**(headers or {}), 'Vary': 'Accept-Encoding'}
+    sent_body = body
+    if len(body) >= min_compress_size and 'gzip' in accepted_encodings(request):
+        with span('compress') as compress_span:
+            sent_body = gzip.compress(body, compresslevel=5)
+        response_encoding_seconds.observe(compress_span.seconds, endpoint=request.url.path, step='compress')
+        headers['Content-Encoding'] = 'gzip'
+    response_bytes.inc(len(body), endpoint=request.url.path)
+    response_sent_bytes.inc(len(sent_body), endpoint=request.url.path, encoding=headers.get('Content-Encoding', 'identity'))
+    return Response(content=sent_body, status_code=status_code, media_type='application/json', headers=headers)
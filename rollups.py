@@ -0,0 +1,89 @@
+import datetime
+
+import pandas as pd
+
+from metrics import span
+from report_cache import ReportCache, date_range
+from singleflight import coalesced
+
+
+class RollupStore:
+    """
+    Analytics pre-aggregated per day, so any date range is a sum over small frames.
+
+    Rollups are built from one GA4 report each, and stored and built
+    independently of each other, so only the reports behind the rollups
+    actually read are ever run. `builders` maps each rollup's name to a
+    `build(start_date, end_date, refetch=False)` aggregating the days of a span
+    from GA4's reports into {date: {table: frame}}, read through the report
+    cache unless `refetch` is set. Each day of a rollup is one entry of a
+    ReportCache. Days missing from the store are built when first asked for,
+    and days built less than `mutable_days` after them are rebuilt once they
+    are older than `mutable_ttl` seconds, as GA4 may still be updating them.
+    Those days, and every day rebuilt by `backfill`, are built from reports run
+    again rather than cached ones, which could predate GA4's updates.
+    """
+
+    # bumped when what the tables hold changes, so days are rebuilt
+    key = 'v3'
+
+    def __init__(self, directory, builders, mutable_days=3, mutable_ttl=60 * 60):
+        self.builders = builders
+        self.cache = ReportCache(
+            directory,
+            max_entries=100_000,
+            max_bytes=4 * 1024 * 1024 * 1024,
+            mutable_days=mutable_days,
+            mutable_ttl=mutable_ttl,
+        )
+
+    def days(self, rollup, start_date: datetime.date, end_date: datetime.date, refetch=False):
+        build = self.builders[rollup]
+
+        def build_days(span_start, span_end):
+            if refetch:
+                return build(span_start, span_end, refetch=True)
+            mutable_start = datetime.date.today() - datetime.timedelta(days=self.cache.mutable_days - 1)
+            if span_end < mutable_start:
+                return build(span_start, span_end)
+            if span_start >= mutable_start:
+                return build(span_start, span_end, refetch=True)
+            return {
+                **build(span_start, mutable_start - datetime.timedelta(days=1)),
+                **build(mutable_start, span_end, refetch=True),
+            }
+
+        return self.cache.fetch(f'{self.key}/{rollup}', start_date, end_date, build_days)
+
+    @coalesced
+    def range_sum(self, rollup, table, start_date: datetime.date, end_date: datetime.date, by, value, **filters):
+        """Sums the `value` column, or tuple of columns, by the `by` ones over every day of the range, keeping rows matching `filters`."""
+        days = self.days(rollup, start_date, end_date)
+        with span('rollups.range_sum') as sum_span:
+            df = pd.concat([rollups[table] for rollups in days.values()], ignore_index=True)
+            sum_span.rows = len(df)
+            for column, filter_value in filters.items():
+                df = df[df[column] == filter_value]
+            return df.groupby(list(by) if isinstance(by, tuple) else by, sort=False)[list(value) if isinstance(value, tuple) else value].sum()
+
+    def backfill(self, rollup, start_date: datetime.date, end_date: datetime.date, rebuild=False):
+        """Builds the days of a range missing from a rollup, or every day of it when `rebuild` is set."""
+        if rebuild:
+            for day in date_range(start_date, end_date):
+                self.cache.remove(f'{self.key}/{rollup}', day)
+        self.days(rollup, start_date, end_date, refetch=rebuild)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from main import backfilled_rollups, daily_rollups
+
+    parser = argparse.ArgumentParser(description='Backfills the daily analytics rollups')
+    parser.add_argument('start_date', type=datetime.date.fromisoformat)
+    parser.add_argument('end_date', type=datetime.date.fromisoformat)
+    parser.add_argument('--rollup', action='append', choices=list(daily_rollups.builders), help='defaults to the rollups the app reads ranges from')
+    parser.add_argument('--rebuild', action='store_true', help='re-aggregate days already in the store')
+    args = parser.parse_args()
+    for rollup in args.rollup or backfilled_rollups:
+        daily_rollups.backfill(rollup, args.start_date, args.end_date, rebuild=args.rebuild)
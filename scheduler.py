@@ -0,0 +1,150 @@
+import asyncio
+import fcntl
+import logging
+import os
+import pickle
+import time
+
+import metrics
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+warmed_result_lookups = metrics.Counter('analytics_warmed_result_lookups_total', 'Lookups of precomputed results, by whether one was found.')
+metrics.registry.append(warmed_result_lookups)
+
+
+class ResultsCache:
+    """
+    Results computed ahead of the requests asking for them.
+
+    A refresh builds a whole new generation of results and swaps it in with
+    one assignment, so readers see either the previous generation or the new
+    one. Results older than `max_age` seconds aren't served.
+
+    With a `path`, generations are also written there, and `load_latest`
+    swaps in the latest one written by any process sharing the path. It does
+    the file's I/O, so `get` only ever reads memory.
+    """
+
+    def __init__(self, max_age, path=None):
+        self.max_age = max_age
+        self.path = path
+        # key -> (computed at, result)
+        self._results = {}
+        self._loaded_mtime = None
+
+    def load_latest(self):
+        if self.path is None:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._loaded_mtime:
+                return
+            with open(self.path, 'rb') as f:
+                self._results = pickle.load(f)
+            self._loaded_mtime = mtime
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+    def get(self, key):
+        entry = self._results.get(key)
+        if entry is None or time.time() - entry[0] > self.max_age:
+            warmed_result_lookups.inc(result='miss')
+            return None
+        warmed_result_lookups.inc(result='hit')
+        return entry[1]
+
+    def replace(self, results, keep=()):
+        """Swaps in `results`, keeping the current results of the `keep` keys that failed to recompute."""
+        computed_at = time.time()
+        generation = {key: self._results[key] for key in keep if key in self._results}
+        generation.update((key, (computed_at, result)) for key, result in results.items())
+        self._results = generation
+        if self.path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(generation, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self._loaded_mtime = os.stat(self.path).st_mtime
+
+
+class LeaderLock:
+    """
+    An exclusive lock on a file, held by at most one process at a time until it exits.
+
+    For work every worker would otherwise repeat: whichever process acquires
+    it first does the work, and another takes over if that one goes away.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """Whether this process holds the lock, trying to take it if it doesn't."""
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+
+class Scheduler:
+    """
+    Runs a list of async jobs in order, every `interval` seconds, in the background.
+
+    A failing job is logged and doesn't stop the ones after it, nor the next run.
+    Jobs added as `leader_only` only run in the process holding `leader_lock`.
+    """
+
+    def __init__(self, interval, leader_lock=None):
+        self.interval = interval
+        self.leader_lock = leader_lock
+        self.jobs = []
+        self._task = None
+
+    def add(self, name, job, leader_only=False):
+        self.jobs.append((name, job, leader_only))
+
+    async def run_once(self):
+        is_leader = self.leader_lock is None or self.leader_lock.acquire()
+        for name, job, leader_only in self.jobs:
+            if leader_only and not is_leader:
+                continue
+            try:
+                with span(f'scheduler.{name}'):
+                    await job()
+            except Exception:
+                logger.exception('Scheduled job %s failed', name)
+
+    async def _run_forever(self):
+        while True:
+            await self.run_once()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run_forever())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+async def gather_limited(coroutines, concurrency):
+    """asyncio.gather(..., return_exceptions=True), running at most `concurrency` of the coroutines at once."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(limited(coroutine) for coroutine in coroutines), return_exceptions=True)
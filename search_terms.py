@@ -0,0 +1,70 @@
+import heapq
+import re
+from urllib.parse import unquote_plus
+
+search_param_re = re.compile(r'(?:^|&)search=([^&#]*)')
+
+
+def normalize_search_term(raw):
+    """Decodes a raw query value and folds case and whitespace, so ' Food+' and 'food' are one term."""
+    return ' '.join(unquote_plus(raw).split()).casefold()
+
+
+def extract_search_term(page_path_plus_query_string):
+    """The normalized first `search` parameter of a page's query string, or None."""
+    _, _, query = page_path_plus_query_string.partition('?')
+    match = search_param_re.search(query)
+    if match is None:
+        return None
+    return normalize_search_term(match.group(1)) or None
+
+
+class SpaceSaving:
+    """
+    Weighted space-saving sketch of the heaviest terms, holding at most `capacity` of them.
+
+    Counts are exact as long as there are no more distinct terms than the
+    capacity. Past that, a new term replaces the lightest one and inherits its
+    count, so counts may be overestimated by at most the weight of the
+    lightest term, but a term heavier than that is never dropped. `errors`
+    holds how much each term's count may be overestimated by: the count it
+    inherited.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # (count, term) entries, stale ones are skipped when popped
+        self._heap = []
+
+    def add(self, term, weight=1):
+        counts = self.counts
+        if term in counts:
+            counts[term] += weight
+        elif len(counts) < self.capacity:
+            counts[term] = weight
+            self.errors[term] = 0
+        else:
+            lightest_count, lightest_term = self._pop_lightest()
+            del counts[lightest_term]
+            del self.errors[lightest_term]
+            counts[term] = lightest_count + weight
+            self.errors[term] = lightest_count
+        heapq.heappush(self._heap, (counts[term], term))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, term) for term, count in counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_lightest(self):
+        while True:
+            count, term = heapq.heappop(self._heap)
+            if self.counts.get(term) == count:
+                return count, term
+
+    def top(self, k=None, min_count=0):
+        """[(term, count)] from heaviest to lightest, at most `k` of them."""
+        items = ((term, count) for term, count in self.counts.items() if count >= min_count)
+        if k is None:
+            return sorted(items, key=lambda item: item[1], reverse=True)
+        return heapq.nlargest(k, items, key=lambda item: item[1])
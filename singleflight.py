@@ -0,0 +1,119 @@
+import functools
+import inspect
+import threading
+import time
+
+import metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time.
+
+    A call made while another one with the same key is in flight waits for it
+    and gets its result, or its exception, instead of doing the work again.
+    Results are shared, so callers must not modify them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # calls that did the work, calls that shared someone else's, and how long those waited
+        self.misses = 0
+        self.hits = 0
+        self.wait_seconds = 0.0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.misses += 1
+                is_leader = True
+            else:
+                self.hits += 1
+                is_leader = False
+
+        if not is_leader:
+            start = time.perf_counter()
+            call.done.wait()
+            with self._lock:
+                self.wait_seconds += time.perf_counter() - start
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'inFlight': len(self._calls),
+                'misses': self.misses,
+                'hits': self.hits,
+                'waitSeconds': self.wait_seconds,
+            }
+
+
+# function name -> its SingleFlight, for reporting
+flights = {}
+
+
+def coalesced(fn):
+    """Decorates fn so concurrent calls with the same arguments share one call."""
+    signature = inspect.signature(fn)
+    flight = flights.setdefault(fn.__qualname__, SingleFlight())
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # bind so that f(a, b) and f(a, b, c=<default>) are the same key
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = tuple(
+            (name, tuple(sorted(value.items())) if isinstance(value, dict) else value)
+            for name, value in bound.arguments.items()
+        )
+        return flight.do(key, fn, *args, **kwargs)
+
+    wrapper.flight = flight
+    return wrapper
+
+
+def stats():
+    return {name: flight.stats() for name, flight in flights.items()}
+
+
+def metric_lines():
+    lines = [
+        '# HELP singleflight_calls_total Calls of coalesced functions, by whether they shared an in-flight call.',
+        '# TYPE singleflight_calls_total counter',
+    ]
+    waits = [
+        '# HELP singleflight_wait_seconds_total Time calls spent waiting for an in-flight call to finish.',
+        '# TYPE singleflight_wait_seconds_total counter',
+    ]
+    for name, flight_stats in stats().items():
+        labels = metrics.format_labels((('function', name),))
+        lines.append(f'singleflight_calls_total{metrics.format_labels((("function", name), ("result", "miss")))} {flight_stats["misses"]}')
+        lines.append(f'singleflight_calls_total{metrics.format_labels((("function", name), ("result", "hit")))} {flight_stats["hits"]}')
+        waits.append(f'singleflight_wait_seconds_total{labels} {flight_stats["waitSeconds"]}')
+    return lines + waits
+
+
+metrics.collectors.append(metric_lines)
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+
+class PolygonIndex:
+    """
+    In-memory index over a set of labeled polygons.
+
+    An STR tree over the polygons' bounding boxes narrows each point down to a
+    few candidates, which are then tested exactly, matching PostGIS'
+    ST_Contains: points on a polygon's boundary are not inside it.
+    """
+
+    def __init__(self, labels, wkbs):
+        self.labels = np.asarray(labels, dtype=object)
+        self.polygons = shapely.from_wkb([bytes(wkb) for wkb in wkbs])
+        self.tree = STRtree(self.polygons)
+
+    def contains(self, longitudes, latitudes):
+        """Returns (point index, label) arrays for every polygon containing every point."""
+        points = shapely.points(np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float))
+        point_indices, polygon_indices = self.tree.query(points, predicate='within')
+        return point_indices, self.labels[polygon_indices]
+
+
+def assign_points(index: PolygonIndex, keys, longitudes, latitudes, label_column, key_column='slug'):
+    """Assigns each keyed point to the polygons containing it, one row per match like a spatial join."""
+    keys = np.asarray(keys, dtype=object)
+    point_indices, labels = index.contains(longitudes, latitudes)
+    return pd.DataFrame({label_column: labels}, index=pd.Index(keys[point_indices], name=key_column))